@@ -0,0 +1,105 @@
+import argparse
+import time
+
+import numpy as np
+
+from symdata.bbox import bbox_overlaps
+from symnet.logger import logger
+
+
+def loop_overlaps(boxes, query_boxes):
+    """reference bbox_overlaps as a double loop over box pairs"""
+    n_ = boxes.shape[0]
+    k_ = query_boxes.shape[0]
+    overlaps = np.zeros((n_, k_), dtype=np.float64)
+    for k in range(k_):
+        query_box_area = (query_boxes[k, 2] - query_boxes[k, 0] + 1) * (query_boxes[k, 3] - query_boxes[k, 1] + 1)
+        for n in range(n_):
+            iw = min(boxes[n, 2], query_boxes[k, 2]) - max(boxes[n, 0], query_boxes[k, 0]) + 1
+            if iw > 0:
+                ih = min(boxes[n, 3], query_boxes[k, 3]) - max(boxes[n, 1], query_boxes[k, 1]) + 1
+                if ih > 0:
+                    box_area = (boxes[n, 2] - boxes[n, 0] + 1) * (boxes[n, 3] - boxes[n, 1] + 1)
+                    all_area = float(box_area + query_box_area - iw * ih)
+                    overlaps[n, k] = iw * ih / all_area
+    return overlaps
+
+
+def random_boxes(rng, num, im_height, im_width, degenerate=0.):
+    """boxes inside the image, a degenerate fraction of them get zero or negative width or height"""
+    xs = np.sort(rng.uniform(0, im_width - 1, (num, 2)), axis=1)
+    ys = np.sort(rng.uniform(0, im_height - 1, (num, 2)), axis=1)
+    boxes = np.stack((xs[:, 0], ys[:, 0], xs[:, 1], ys[:, 1]), axis=1)
+    # width x2 - x1 + 1 is 0 or negative
+    bad = rng.random_sample(num) < degenerate
+    boxes[bad, 2] = boxes[bad, 0] - rng.randint(1, 4, bad.sum())
+    bad = rng.random_sample(num) < degenerate
+    boxes[bad, 3] = boxes[bad, 1] - rng.randint(1, 4, bad.sum())
+    return boxes
+
+
+def check(args, rng):
+    """compare bbox_overlaps with the loop, raise if any overlap differs by more than 1e-12"""
+    cases = [
+        ('random', random_boxes(rng, 500, args.im_height, args.im_width),
+         random_boxes(rng, 20, args.im_height, args.im_width), None),
+        ('integer', np.round(random_boxes(rng, 500, args.im_height, args.im_width)),
+         np.round(random_boxes(rng, 20, args.im_height, args.im_width)), None),
+        ('degenerate', random_boxes(rng, 500, args.im_height, args.im_width, degenerate=0.3),
+         random_boxes(rng, 20, args.im_height, args.im_width, degenerate=0.3), None),
+        ('empty boxes', np.zeros((0, 4)), random_boxes(rng, 20, args.im_height, args.im_width), None),
+        ('empty query', random_boxes(rng, 500, args.im_height, args.im_width), np.zeros((0, 4)), None),
+        # 3000 x 20 pairs in blocks of 1000 pairs, the last block is partial
+        ('blocked', random_boxes(rng, 3000, args.im_height, args.im_width, degenerate=0.1),
+         random_boxes(rng, 20, args.im_height, args.im_width, degenerate=0.1), 1000),
+        ('block smaller than k', random_boxes(rng, 200, args.im_height, args.im_width),
+         random_boxes(rng, 50, args.im_height, args.im_width), 10),
+    ]
+    for name, boxes, query_boxes, block_size in cases:
+        kwargs = {'block_size': block_size} if block_size is not None else {}
+        overlaps = bbox_overlaps(boxes, query_boxes, **kwargs)
+        expected = loop_overlaps(boxes, query_boxes)
+        assert overlaps.dtype == np.float64 and overlaps.shape == expected.shape, name
+        diff = np.abs(overlaps - expected).max(initial=0)
+        assert diff < 1e-12, '{}: max abs difference {}'.format(name, diff)
+        logger.info('{} {}x{}: max abs difference {:.1e}'.format(name, len(boxes), len(query_boxes), diff))
+
+
+def bench(fn, boxes, query_boxes, iters):
+    tic = time.time()
+    for _ in range(iters):
+        fn(boxes, query_boxes)
+    return (time.time() - tic) / iters * 1e3
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check and benchmark bbox_overlaps against the python loop',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-boxes', type=int, nargs='+', default=[2000, 20000], help='boxes, e.g. rois or anchors')
+    parser.add_argument('--num-query', type=int, default=10, help='query boxes, e.g. gt boxes')
+    parser.add_argument('--im-height', type=int, default=600, help='image height')
+    parser.add_argument('--im-width', type=int, default=1000, help='image width')
+    parser.add_argument('--iters', type=int, default=20, help='timed bbox_overlaps calls')
+    parser.add_argument('--skip-loop', action='store_true', help='do not time the python loop')
+    parser.add_argument('--skip-check', action='store_true', help='do not compare with the python loop')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of boxes')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    if not args.skip_check:
+        check(args, rng)
+    for num_boxes in args.num_boxes:
+        boxes = random_boxes(rng, num_boxes, args.im_height, args.im_width)
+        query_boxes = random_boxes(rng, args.num_query, args.im_height, args.im_width)
+        msec = bench(bbox_overlaps, boxes, query_boxes, args.iters)
+        msg = '{}x{}: {:.2f} ms per call'.format(num_boxes, args.num_query, msec)
+        if not args.skip_loop:
+            msg += ', python loop {:.2f} ms'.format(bench(loop_overlaps, boxes, query_boxes, 1))
+        logger.info(msg)
+
+
+if __name__ == '__main__':
+    main()
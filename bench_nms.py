@@ -0,0 +1,101 @@
+import argparse
+import time
+
+import numpy as np
+
+from symdata.bbox import bbox_pred, clip_boxes, nms, multiclass_nms, multiclass_soft_nms
+from symnet.logger import logger
+
+
+def random_outputs(rng, num_rois, num_classes, num_objects, logit_std, im_height, im_width):
+    """rcnn outputs of one image as im_detect takes them, rois cluster around a few objects"""
+    centers = rng.uniform((0, 0), (im_width, im_height), (num_objects, 2))
+    sizes = rng.uniform(32, 300, (num_objects, 2))
+    obj = rng.randint(0, num_objects, num_rois)
+    ctr = centers[obj] + rng.normal(0, 0.2, (num_rois, 2)) * sizes[obj]
+    size = sizes[obj] * rng.uniform(0.6, 1.4, (num_rois, 2))
+    rois = np.hstack((ctr - size / 2, ctr + size / 2)).astype(np.float32)
+    rois = clip_boxes(rois, (im_height, im_width))
+
+    # every object favours one class, the rest of the scores spread over all classes
+    logits = rng.normal(0, logit_std, (num_rois, num_classes))
+    logits[np.arange(num_rois), rng.randint(1, num_classes, num_objects)[obj]] += 2 * logit_std
+    scores = np.exp(logits - logits.max(axis=1, keepdims=True))
+    scores = (scores / scores.sum(axis=1, keepdims=True)).astype(np.float32)
+    bbox_deltas = rng.normal(0, 0.1, (num_rois, 4 * num_classes)).astype(np.float32)
+    im_info = np.array([im_height, im_width, 1.0], dtype=np.float32)
+    return rois, scores, bbox_deltas, im_info
+
+
+def candidates(rois, scores, bbox_deltas, im_info, bbox_stds, conf_thresh):
+    """boxes, scores and classes of all foreground candidates above conf_thresh, as in im_detect"""
+    height, width, scale = im_info
+    pred_boxes = clip_boxes(bbox_pred(rois, bbox_deltas, bbox_stds), (height, width)) / scale
+    cls_inds, roi_inds = np.where(scores[:, 1:].T > conf_thresh)
+    cls_inds += 1
+    cls_boxes = pred_boxes.reshape((pred_boxes.shape[0], scores.shape[1], 4))[roi_inds, cls_inds]
+    return cls_boxes, scores[roi_inds, cls_inds], cls_inds
+
+
+def per_class_nms(boxes, scores, classes, thresh):
+    """hard nms class by class, as im_detect without batched_nms"""
+    keep = []
+    for cls_ind in np.unique(classes):
+        inds = np.where(classes == cls_ind)[0]
+        keep.append(inds[nms(np.hstack((boxes[inds], scores[inds, np.newaxis])), thresh)])
+    return np.concatenate(keep)
+
+
+def bench(fn, iters):
+    tic = time.time()
+    for _ in range(iters):
+        result = fn()
+    return (time.time() - tic) / iters * 1e3, result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark hard nms against soft nms on im_detect candidates',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-rois', type=int, nargs='+', default=[300, 1000], help='rcnn rois per image')
+    parser.add_argument('--num-classes', type=int, nargs='+', default=[21, 81],
+                        help='number of classes including background')
+    parser.add_argument('--num-objects', type=int, default=10, help='objects the rois cluster around')
+    parser.add_argument('--logit-std', type=float, default=2.0,
+                        help='spread of class logits, lower gives more candidates')
+    parser.add_argument('--conf-thresh', type=float, default=1e-3, help='score threshold of candidates')
+    parser.add_argument('--nms-thresh', type=float, default=0.3, help='hard nms overlap threshold')
+    parser.add_argument('--soft-nms-thresh', type=float, default=0.6, help='gaussian sigma or linear overlap')
+    parser.add_argument('--bbox-stds', type=float, nargs=4, default=(0.1, 0.1, 0.2, 0.2), help='rcnn bbox stds')
+    parser.add_argument('--im-height', type=int, default=600, help='image height')
+    parser.add_argument('--im-width', type=int, default=1000, help='image width')
+    parser.add_argument('--iters', type=int, default=20, help='timed calls')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of inputs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    for num_classes in args.num_classes:
+        for num_rois in args.num_rois:
+            outputs = random_outputs(rng, num_rois, num_classes, args.num_objects, args.logit_std,
+                                     args.im_height, args.im_width)
+            boxes, scores, classes = candidates(*outputs, bbox_stds=args.bbox_stds, conf_thresh=args.conf_thresh)
+            methods = [
+                ('per class nms', lambda: per_class_nms(boxes, scores, classes, args.nms_thresh)),
+                ('multiclass_nms', lambda: multiclass_nms(boxes, scores, classes, args.nms_thresh)),
+            ]
+            # hard decay with nms_thresh keeps the same boxes as multiclass_nms
+            for method, thresh in (('linear', args.soft_nms_thresh), ('gaussian', args.soft_nms_thresh),
+                                   ('hard', args.nms_thresh)):
+                methods.append(('multiclass_soft_nms ' + method, lambda method=method, thresh=thresh:
+                                multiclass_soft_nms(boxes, scores, classes, method=method, sigma=thresh, Nt=thresh,
+                                                    threshold=args.conf_thresh)[0]))
+            for name, fn in methods:
+                msec, keep = bench(fn, args.iters)
+                logger.info('{} rois {} classes {} candidates, {}: {:.2f} ms per image, {} kept'.format(
+                    num_rois, num_classes, len(scores), name, msec, len(keep)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import time
+
+import mxnet as mx
+import numpy as np
+
+from symnet import proposal_target
+from symnet.logger import logger
+
+
+def random_inputs(rng, batch_images, num_rois, num_gt, num_classes, im_height, im_width):
+    """rpn rois of every image, a quarter jittered around gt boxes so that there are fg rois to sample"""
+    gt_boxes = np.zeros((batch_images, num_gt, 5), dtype=np.float32)
+    x1 = rng.uniform(0, im_width - 100, (batch_images, num_gt))
+    y1 = rng.uniform(0, im_height - 100, (batch_images, num_gt))
+    gt_boxes[:, :, 0] = x1
+    gt_boxes[:, :, 1] = y1
+    gt_boxes[:, :, 2] = np.minimum(x1 + rng.uniform(32, 400, x1.shape), im_width - 1)
+    gt_boxes[:, :, 3] = np.minimum(y1 + rng.uniform(32, 400, y1.shape), im_height - 1)
+    gt_boxes[:, :, 4] = rng.randint(1, num_classes, x1.shape)
+
+    rois = np.zeros((batch_images, num_rois, 5), dtype=np.float32)
+    rois[:, :, 0] = np.arange(batch_images)[:, np.newaxis]
+    xs = np.sort(rng.uniform(0, im_width - 1, (batch_images, num_rois, 2)), axis=2)
+    ys = np.sort(rng.uniform(0, im_height - 1, (batch_images, num_rois, 2)), axis=2)
+    rois[:, :, 1:] = np.stack((xs[:, :, 0], ys[:, :, 0], xs[:, :, 1], ys[:, :, 1]), axis=2)
+    num_near = num_rois // 4
+    near = rng.randint(0, num_gt, (batch_images, num_near))
+    rois[:, :num_near, 1:] = gt_boxes[np.arange(batch_images)[:, np.newaxis], near, :4] + \
+        rng.normal(0, 8, (batch_images, num_near, 4))
+    return rois.reshape((-1, 5)), gt_boxes
+
+
+def bench_forward(args, batch_rois, rng):
+    rois, gt_boxes = random_inputs(rng, args.batch_images, args.num_rois, args.num_gt, args.num_classes,
+                                   args.im_height, args.im_width)
+    rois = mx.nd.array(rois)
+    gt_boxes = mx.nd.array(gt_boxes)
+
+    if args.device_sampling:
+        sym = mx.sym.Group(proposal_target.proposal_target_sym(
+            mx.sym.var('rois'), mx.sym.var('gt_boxes'), num_classes=args.num_classes,
+            batch_images=args.batch_images, batch_rois=batch_rois, fg_fraction=args.fg_fraction,
+            fg_overlap=args.fg_overlap, box_stds=args.box_stds))
+        exe = sym.bind(mx.cpu(), {'rois': rois, 'gt_boxes': gt_boxes}, grad_req='null')
+
+    def forward():
+        if args.device_sampling:
+            outs = exe.forward(is_train=True)
+        else:
+            outs = mx.nd.Custom(rois, gt_boxes, op_type='proposal_target',
+                                num_classes=args.num_classes, batch_images=args.batch_images,
+                                batch_rois=batch_rois, fg_fraction=args.fg_fraction,
+                                fg_overlap=args.fg_overlap, box_stds=str(args.box_stds))
+        mx.nd.waitall()
+        return outs
+
+    for _ in range(args.warmup):
+        forward()
+    tic = time.time()
+    for _ in range(args.iters):
+        forward()
+    return (time.time() - tic) / args.iters * 1e6
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark proposal_target forward',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch-rois', type=int, nargs='+', default=[128, 256, 512], help='rcnn rois per batch')
+    parser.add_argument('--batch-images', type=int, default=1, help='images per batch')
+    parser.add_argument('--num-rois', type=int, default=2000, help='rpn rois per image')
+    parser.add_argument('--num-gt', type=int, default=8, help='gt boxes per image')
+    parser.add_argument('--num-classes', type=int, default=21, help='number of classes including background')
+    parser.add_argument('--fg-fraction', type=float, default=0.25, help='rcnn foreground fraction')
+    parser.add_argument('--fg-overlap', type=float, default=0.5, help='rcnn foreground iou threshold')
+    parser.add_argument('--box-stds', type=float, nargs=4, default=(0.1, 0.1, 0.2, 0.2), help='rcnn bbox stds')
+    parser.add_argument('--im-height', type=int, default=600, help='image height')
+    parser.add_argument('--im-width', type=int, default=1000, help='image width')
+    parser.add_argument('--device-sampling', action='store_true', help='time proposal_target_sym instead of the custom op')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed forward calls')
+    parser.add_argument('--iters', type=int, default=200, help='timed forward calls')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of inputs')
+    args = parser.parse_args()
+    args.box_stds = tuple(args.box_stds)
+    return args
+
+
+def main():
+    args = parse_args()
+    rng = np.random.RandomState(args.seed)
+    for batch_rois in args.batch_rois:
+        usec = bench_forward(args, batch_rois, rng)
+        logger.info('batch_images {} num_rois {} batch_rois {}: {:.1f} us per forward'.format(
+            args.batch_images, args.num_rois, batch_rois, usec))
+
+
+if __name__ == '__main__':
+    main()
@@ -57,7 +57,8 @@ def demo_net(sym, class_names, args):
     det = im_detect(rois, scores, bbox_deltas, im_info,
                     bbox_stds=args.rcnn_bbox_stds, nms_thresh=args.rcnn_nms_thresh,
                     conf_thresh=args.rcnn_conf_thresh, use_soft_nms=args.use_soft_nms,
-                            soft_nms_thresh=args.soft_nms_thresh, max_per_image=args.max_per_image)
+                    soft_nms_thresh=args.soft_nms_thresh, max_per_image=args.max_per_image,
+                    soft_nms_method=args.soft_nms_method)
 
     # print out
     for [cls, conf, x1, y1, x2, y2] in det:
@@ -98,8 +99,9 @@ def parse_args():
     parser.add_argument('--rcnn-bbox-stds', type=str, default='(0.1, 0.1, 0.2, 0.2)')
     parser.add_argument('--rcnn-nms-thresh', type=float, default=0.3)
     parser.add_argument('--rcnn-conf-thresh', type=float, default=1e-3)
-    parser.add_argument('--use-soft-nms', type=bool, default=True)
-    parser.add_argument('--soft-nms-thresh', type=float, default=0.6)
+    parser.add_argument('--use-soft-nms', action='store_true', help='decay scores instead of hard nms')
+    parser.add_argument('--soft-nms-method', type=str, default='gaussian', choices=['linear', 'gaussian'])
+    parser.add_argument('--soft-nms-thresh', type=float, default=0.6, help='gaussian sigma or linear overlap')
     parser.add_argument('--max-per-image', type=int, default=100)
     args = parser.parse_args()
     args.img_pixel_means = ast.literal_eval(args.img_pixel_means)
@@ -1,14 +1,64 @@
+from collections import OrderedDict
+
 import numpy as np
 from symdata.bbox import bbox_overlaps, bbox_transform
 
 
+class LRUCache:
+    """least recently used cache that counts hits and misses"""
+    def __init__(self, capacity=8):
+        self._capacity = capacity
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, fn):
+        """return cached value for key, compute it with fn() on a miss"""
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+        self.misses += 1
+        value = fn()
+        self._items[key] = value
+        if len(self._items) > self._capacity:
+            self._items.popitem(last=False)
+        return value
+
+    def reset_stats(self):
+        """return hits, misses since the last reset"""
+        stats = self.hits, self.misses
+        self.hits, self.misses = 0, 0
+        return stats
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return 'hits={} misses={} size={}/{}'.format(self.hits, self.misses, len(self._items), self._capacity)
+
+
 class AnchorGenerator:
-    def __init__(self, feat_stride=16, anchor_scales=(8, 16, 32), anchor_ratios=(0.5, 1, 2)):
+    def __init__(self, feat_stride=16, anchor_scales=(8, 16, 32), anchor_ratios=(0.5, 1, 2), cache_size=8):
         self._num_anchors = len(anchor_scales) * len(anchor_ratios)
         self._feat_stride = feat_stride
         self._base_anchors = self._generate_base_anchors(feat_stride, np.array(anchor_scales), np.array(anchor_ratios))
+        self._cache = LRUCache(cache_size)
+
+    @property
+    def num_anchors(self):
+        return self._num_anchors
+
+    @property
+    def cache(self):
+        return self._cache
 
     def generate(self, feat_height, feat_width):
+        """return read-only (K*A, 4) anchors, cached by feature shape"""
+        return self._cache.get((int(feat_height), int(feat_width)),
+                               lambda: self._generate(feat_height, feat_width))
+
+    def _generate(self, feat_height, feat_width):
         shift_x = np.arange(0, feat_width) * self._feat_stride
         shift_y = np.arange(0, feat_height) * self._feat_stride
         shift_x, shift_y = np.meshgrid(shift_x, shift_y)
@@ -21,6 +71,8 @@ class AnchorGenerator:
         K = shifts.shape[0]
         all_anchors = self._base_anchors.reshape((1, A, 4)) + shifts.reshape((1, K, 4)).transpose((1, 0, 2))
         all_anchors = all_anchors.reshape((K * A, 4))
+        # shared between batches, must not be modified in place
+        all_anchors.setflags(write=False)
         return all_anchors
 
     @staticmethod
@@ -86,87 +138,277 @@ class AnchorGenerator:
 
 
 class AnchorSampler:
-    def __init__(self, allowed_border=0, batch_rois=256, fg_fraction=0.5, fg_overlap=0.7, bg_overlap=0.3):
+    def __init__(self, allowed_border=0, batch_rois=256, fg_fraction=0.5, fg_overlap=0.7, bg_overlap=0.3,
+                 cache_size=64):
         self._allowed_border = allowed_border
         self._num_batch = batch_rois
         self._num_fg = int(batch_rois * fg_fraction)
         self._fg_overlap = fg_overlap
         self._bg_overlap = bg_overlap
+        self._cache = LRUCache(cache_size)
 
-    def assign(self, anchors, gt_boxes, im_height, im_width):
+    @property
+    def cache(self):
+        return self._cache
+
+    def assign(self, anchors, gt_boxes, im_height, im_width, rng=np.random, out=None, feat_shape=None):
+        """
+        label anchors of one image
+        :param anchors: (K*A, 4) anchors in (H, W, A) order
+        :param rng: random state used for subsampling
+        :param out: optional preallocated (labels, bbox_targets, bbox_weights) to write into
+        :param feat_shape: (H, W) of anchors, outputs are then laid out as (A, H, W), (4 * A, H, W), (4 * A, H, W)
+                           and anchors inside the image are cached by feat_shape and image size
+        :return: labels, bbox_targets, bbox_weights, of (N,), (N, 4), (N, 4) without feat_shape
+        """
         num_anchors = anchors.shape[0]
 
         # filter out padded gt_boxes
-        valid_labels = np.where(gt_boxes[:, -1] > 0)[0]
-        gt_boxes = gt_boxes[valid_labels]
+        gt_boxes = gt_boxes[gt_boxes[:, -1] > 0]
 
         # filter out anchors outside the region
-        inds_inside = np.where((anchors[:, 0] >= -self._allowed_border) &
-                               (anchors[:, 2] < im_width + self._allowed_border) &
-                               (anchors[:, 1] >= -self._allowed_border) &
-                               (anchors[:, 3] < im_height + self._allowed_border))[0]
-        anchors = anchors[inds_inside, :]
-        num_valid = len(inds_inside)
+        if feat_shape is None:
+            inds_inside, anchors = self._inside(anchors, im_height, im_width)
+        else:
+            key = (int(feat_shape[0]), int(feat_shape[1]), int(im_height), int(im_width))
+            inds_inside, anchors = self._cache.get(key, lambda: self._inside(anchors, im_height, im_width))
+
+        if out is None:
+            if feat_shape is None:
+                shapes = (num_anchors,), (num_anchors, 4), (num_anchors, 4)
+            else:
+                A = num_anchors // (feat_shape[0] * feat_shape[1])
+                shapes = (A,) + tuple(feat_shape), (4 * A,) + tuple(feat_shape), (4 * A,) + tuple(feat_shape)
+            out = tuple(np.empty(shape, dtype=np.float32) for shape in shapes)
+        all_labels, all_bbox_targets, all_bbox_weights = out
+        assert all_labels.size == num_anchors and all_bbox_targets.size == all_bbox_weights.size == 4 * num_anchors
 
         # label: 1 is positive, 0 is negative, -1 is dont care
-        labels = np.ones((num_valid,), dtype=np.float32) * -1
-        bbox_targets = np.zeros((num_valid, 4), dtype=np.float32)
-        bbox_weights = np.zeros((num_valid, 4), dtype=np.float32)
+        all_labels.fill(-1)
+        all_bbox_targets.fill(0)
+        all_bbox_weights.fill(0)
 
-        # sample for positive labels
         if gt_boxes.size > 0:
             # overlap between the anchors and the gt boxes
             # overlaps (ex, gt)
-            overlaps = bbox_overlaps(anchors.astype(np.float), gt_boxes.astype(np.float))
-
-            # fg anchors: anchor with highest overlap for each gt
-            gt_max_overlaps = overlaps.max(axis=0)
-            argmax_inds = np.where(overlaps == gt_max_overlaps)[0]
-            labels[argmax_inds] = 1
-
-            # fg anchors: anchor with overlap > iou thresh
-            max_overlaps = overlaps.max(axis=1)
-            labels[max_overlaps >= self._fg_overlap] = 1
-
-            # bg anchors: anchor with overlap < iou thresh
-            labels[max_overlaps < self._bg_overlap] = 0
-
-            # sanity check
-            fg_inds = np.where(labels == 1)[0]
-            bg_inds = np.where(labels == 0)[0]
-            assert len(np.intersect1d(fg_inds, bg_inds)) == 0
-
-            # subsample positive anchors
-            cur_fg = len(fg_inds)
-            if cur_fg > self._num_fg:
-                disable_inds = np.random.choice(fg_inds, size=(cur_fg - self._num_fg), replace=False)
-                labels[disable_inds] = -1
-
-            # subsample negative anchors
-            cur_bg = len(bg_inds)
-            max_neg = self._num_batch - min(self._num_fg, cur_fg)
-            if cur_bg > max_neg:
-                disable_inds = np.random.choice(bg_inds, size=(cur_bg - max_neg), replace=False)
-                labels[disable_inds] = -1
-
-            # assign to argmax overlap
-            fg_inds = np.where(labels == 1)[0]
+            overlaps = bbox_overlaps(anchors, gt_boxes)
             argmax_overlaps = overlaps.argmax(axis=1)
-            bbox_targets[fg_inds, :] = bbox_transform(anchors[fg_inds, :], gt_boxes[argmax_overlaps[fg_inds], :],
-                                                      box_stds=(1.0, 1.0, 1.0, 1.0))
+            max_overlaps = overlaps[np.arange(len(anchors)), argmax_overlaps]
 
-            # only fg anchors has bbox_targets
-            bbox_weights[fg_inds, :] = 1
+            # fg anchors: anchor with highest overlap for each gt or with overlap > iou thresh
+            # bg anchors: anchor with overlap < iou thresh, also when it is the best anchor of a gt
+            is_bg = max_overlaps < self._bg_overlap
+            is_fg = (max_overlaps >= self._fg_overlap) | (overlaps == overlaps.max(axis=0)).any(axis=1)
+            fg_inds = np.where(is_fg & ~is_bg)[0]
+            bg_inds = np.where(is_bg)[0]
+
+            # subsample positive and negative anchors
+            fg_inds = self._subsample(fg_inds, self._num_fg, rng)
+            bg_inds = self._subsample(bg_inds, self._num_batch - len(fg_inds), rng)
+
+            # only fg anchors have bbox_targets, assigned to argmax overlap
+            bbox_targets = bbox_transform(anchors[fg_inds, :], gt_boxes[argmax_overlaps[fg_inds], :],
+                                          box_stds=(1.0, 1.0, 1.0, 1.0))
         else:
             # randomly draw bg anchors
-            bg_inds = np.random.choice(np.arange(num_valid), size=self._num_batch, replace=False)
-            labels[bg_inds] = 0
+            fg_inds = np.empty((0,), dtype=np.int64)
+            bg_inds = self._subsample(np.arange(len(anchors)), self._num_batch, rng)
+            bbox_targets = np.empty((0, 4), dtype=np.float32)
 
-        all_labels = np.ones((num_anchors,), dtype=np.float32) * -1
-        all_labels[inds_inside] = labels
-        all_bbox_targets = np.zeros((num_anchors, 4), dtype=np.float32)
-        all_bbox_targets[inds_inside, :] = bbox_targets
-        all_bbox_weights = np.zeros((num_anchors, 4), dtype=np.float32)
-        all_bbox_weights[inds_inside, :] = bbox_weights
+        # scatter sampled anchors into the full anchor set
+        fg_inds = inds_inside[fg_inds]
+        bg_inds = inds_inside[bg_inds]
+        if feat_shape is None:
+            all_labels[bg_inds] = 0
+            all_labels[fg_inds] = 1
+            all_bbox_targets[fg_inds, :] = bbox_targets
+            all_bbox_weights[fg_inds, :] = 1
+        else:
+            # anchor k * A + a in (H, W, A) order is a * H * W + k in (A, H, W) order
+            A = all_labels.size // (feat_shape[0] * feat_shape[1])
+            labels = all_labels.reshape((A, -1))
+            labels[bg_inds % A, bg_inds // A] = 0
+            labels[fg_inds % A, fg_inds // A] = 1
+            all_bbox_targets.reshape((A, 4, -1))[fg_inds % A, :, fg_inds // A] = bbox_targets
+            all_bbox_weights.reshape((A, 4, -1))[fg_inds % A, :, fg_inds // A] = 1
 
         return all_labels, all_bbox_targets, all_bbox_weights
+
+    def assign_batch(self, anchors, gt_boxes, im_heights, im_widths, feat_shape, rng=np.random, out=None):
+        """
+        label anchors of all images in a batch in one pass, images share anchors but differ in size
+        :param anchors: (H*W*A, 4) anchors in (H, W, A) order
+        :param gt_boxes: (B, G, 5) stacked gt boxes, padded with class <= 0
+        :param im_heights: (B,) real image heights
+        :param im_widths: (B,) real image widths
+        :param feat_shape: (H, W) of anchors
+        :param rng: random state used for subsampling
+        :param out: optional preallocated (labels, bbox_targets, bbox_weights) to write into
+        :return: labels, bbox_targets, bbox_weights of (B, A, H, W), (B, 4 * A, H, W), (B, 4 * A, H, W)
+        """
+        num_batch = gt_boxes.shape[0]
+        A = anchors.shape[0] // (feat_shape[0] * feat_shape[1])
+        if out is None:
+            out = (np.empty((num_batch, A) + tuple(feat_shape), dtype=np.float32),
+                   np.empty((num_batch, 4 * A) + tuple(feat_shape), dtype=np.float32),
+                   np.empty((num_batch, 4 * A) + tuple(feat_shape), dtype=np.float32))
+        all_labels, all_bbox_targets, all_bbox_weights = out
+        assert all_labels.size == num_batch * anchors.shape[0] and \
+            all_bbox_targets.size == all_bbox_weights.size == 4 * all_labels.size
+
+        # label: 1 is positive, 0 is negative, -1 is dont care
+        all_labels.fill(-1)
+        all_bbox_targets.fill(0)
+        all_bbox_weights.fill(0)
+
+        # anchors inside each image (B, N), cached by feat_shape and image size
+        # overlaps are only computed for anchors inside any image
+        inside = np.zeros((num_batch, anchors.shape[0]), dtype=bool)
+        for batch_ind, (im_height, im_width) in enumerate(zip(im_heights, im_widths)):
+            key = (int(feat_shape[0]), int(feat_shape[1]), int(im_height), int(im_width))
+            b_inds_inside, _ = self._cache.get(key, lambda: self._inside(anchors, im_height, im_width))
+            inside[batch_ind, b_inds_inside] = True
+        inds_inside = np.where(inside.any(axis=0))[0]
+        all_anchors = anchors
+        anchors = anchors[inds_inside, :]
+        inside = inside[:, inds_inside]
+
+        # overlaps (valid gt of all images, ex), -1 for anchors outside the image of the gt
+        valid_gt = gt_boxes[:, :, -1] > 0
+        gt_batch = np.where(valid_gt)[0]
+        gt_boxes = gt_boxes[valid_gt]
+        overlaps = self._grid_overlaps(all_anchors, feat_shape, gt_boxes, inds_inside)
+        overlaps[~inside[gt_batch]] = -1
+
+        # gt of an image are consecutive rows of overlaps, reduce them per image
+        # fg anchors: anchor with highest overlap for each gt
+        max_overlaps = np.full(inside.shape, -1.0)
+        is_best = np.zeros(inside.shape, dtype=bool)
+        gt_max_overlaps = overlaps.max(axis=1, initial=-1)
+        gt_ends = np.searchsorted(gt_batch, np.arange(num_batch), side='right')
+        for batch_ind, (start, end) in enumerate(zip(np.append(0, gt_ends[:-1]), gt_ends)):
+            if start < end:
+                np.maximum.reduce(overlaps[start:end], axis=0, out=max_overlaps[batch_ind])
+                np.logical_or.reduce(overlaps[start:end] == gt_max_overlaps[start:end, np.newaxis], axis=0,
+                                     out=is_best[batch_ind])
+
+        # fg anchors: or anchor with overlap > iou thresh
+        # bg anchors: anchor with overlap < iou thresh, also when it is the best anchor of a gt
+        # images without gt only have bg anchors
+        has_gt = valid_gt.any(axis=1)[:, np.newaxis]
+        is_bg = inside & (~has_gt | (max_overlaps < self._bg_overlap))
+        is_fg = inside & ~is_bg & ((max_overlaps >= self._fg_overlap) | is_best)
+
+        # subsample positive and negative anchors of every image
+        keys = rng.random_sample(inside.shape)
+        is_fg = self._subsample_batch(is_fg, keys, np.full((num_batch,), self._num_fg))
+        is_bg = self._subsample_batch(is_bg, keys, self._num_batch - is_fg.sum(axis=1))
+
+        fg_batch, fg_inds = np.where(is_fg)
+        bg_batch, bg_inds = np.where(is_bg)
+
+        # best gt of sampled fg anchors, among gt of their own image
+        fg_overlaps = np.where(gt_batch[:, np.newaxis] == fg_batch, overlaps[:, fg_inds], -2)
+        argmax_overlaps = fg_overlaps.argmax(axis=0) if fg_overlaps.size else np.empty((0,), dtype=np.int64)
+
+        # scatter sampled anchors into the full anchor set
+        # anchor k * A + a in (H, W, A) order is a * H * W + k in (A, H, W) order
+        labels = all_labels.reshape((num_batch, A, -1))
+        bg_anchor = inds_inside[bg_inds]
+        labels[bg_batch, bg_anchor % A, bg_anchor // A] = 0
+        fg_anchor = inds_inside[fg_inds]
+        labels[fg_batch, fg_anchor % A, fg_anchor // A] = 1
+
+        # only fg anchors have bbox_targets, assigned to argmax overlap
+        bbox_targets = bbox_transform(anchors[fg_inds, :], gt_boxes[argmax_overlaps, :],
+                                      box_stds=(1.0, 1.0, 1.0, 1.0))
+        all_bbox_targets.reshape((num_batch, A, 4, -1))[fg_batch, fg_anchor % A, :, fg_anchor // A] = bbox_targets
+        all_bbox_weights.reshape((num_batch, A, 4, -1))[fg_batch, fg_anchor % A, :, fg_anchor // A] = 1
+
+        return all_labels, all_bbox_targets, all_bbox_weights
+
+    def _inside(self, anchors, im_height, im_width):
+        """indexes and read-only copy of anchors inside the image, allowing border"""
+        inds_inside = np.where((anchors[:, 0] >= -self._allowed_border) &
+                               (anchors[:, 2] < im_width + self._allowed_border) &
+                               (anchors[:, 1] >= -self._allowed_border) &
+                               (anchors[:, 3] < im_height + self._allowed_border))[0]
+        anchors = anchors[inds_inside, :]
+        inds_inside.setflags(write=False)
+        anchors.setflags(write=False)
+        return inds_inside, anchors
+
+    @staticmethod
+    def _grid_overlaps(anchors, feat_shape, query_boxes, inds):
+        """
+        bbox_overlaps(anchors[inds], query_boxes).T for grid anchors, with identical results
+        intersection width only depends on anchor column and shape, height on anchor row and shape,
+        so both are computed on (W, A) and (H, A) and only gathered and multiplied for inds
+        :param anchors: (H*W*A, 4) anchors in (H, W, A) order as generated by AnchorGenerator
+        :param feat_shape: (H, W)
+        :param query_boxes: k * 4 bounding boxes
+        :param inds: indexes of anchors to compute overlaps for
+        :return: overlaps: k * len(inds) overlaps
+        """
+        if query_boxes.shape[0] == 0:
+            return np.zeros((0, len(inds)), dtype=np.float64)
+        height, width = feat_shape
+        grid = anchors.reshape((height, width, -1, 4))
+        A = grid.shape[2]
+        query_boxes = query_boxes[:, :4].astype(np.float64, copy=False)
+        # (k, W, A) and (k, H, A)
+        iw = np.minimum(grid[0, :, :, 2], query_boxes[:, 2, np.newaxis, np.newaxis]) - \
+            np.maximum(grid[0, :, :, 0], query_boxes[:, 0, np.newaxis, np.newaxis]) + 1
+        ih = np.minimum(grid[:, 0, :, 3], query_boxes[:, 3, np.newaxis, np.newaxis]) - \
+            np.maximum(grid[:, 0, :, 1], query_boxes[:, 1, np.newaxis, np.newaxis]) + 1
+        # only pairs with positive width and height intersect, the rest get 0
+        np.maximum(iw, 0, out=iw)
+        np.maximum(ih, 0, out=ih)
+
+        # anchors of the same shape have the same area everywhere on the grid
+        box_areas = (grid[0, 0, :, 2] - grid[0, 0, :, 0] + 1) * (grid[0, 0, :, 3] - grid[0, 0, :, 1] + 1)
+        query_box_areas = (query_boxes[:, 2] - query_boxes[:, 0] + 1) * (query_boxes[:, 3] - query_boxes[:, 1] + 1)
+        areas = box_areas + query_box_areas[:, np.newaxis]
+
+        # anchor k * A + a sits in row k // width and column k % width
+        shape_inds = inds % A
+        inters = ih.reshape((query_boxes.shape[0], -1))[:, inds // (width * A) * A + shape_inds]
+        inters *= iw.reshape((query_boxes.shape[0], -1))[:, inds // A % width * A + shape_inds]
+        overlaps = areas[:, shape_inds]
+        overlaps -= inters
+        np.divide(inters, overlaps, out=overlaps)
+        return overlaps
+
+    @staticmethod
+    def _subsample(inds, num, rng):
+        """
+        uniformly draw at most num of inds without replacement
+        ranks random keys with argpartition instead of permuting all inds as rng.choice does
+        """
+        num = max(num, 0)
+        if len(inds) <= num:
+            return inds
+        return inds[np.argpartition(rng.random_sample(len(inds)), num)[:num]]
+
+    @staticmethod
+    def _subsample_batch(mask, keys, nums):
+        """
+        uniformly keep at most nums[b] of the true entries in every row b of mask
+        :param mask: (B, N) bool candidates
+        :param keys: (B, N) random keys, an entry is kept if its key ranks among the nums[b] smallest of its row
+        :param nums: (B,) number to keep per row
+        :return: (B, N) bool of kept entries
+        """
+        nums = np.maximum(nums, 0)
+        max_num = min(int(nums.max()), mask.shape[1])
+        keys = np.where(mask, keys, np.inf)
+        if max_num < mask.shape[1]:
+            cand = np.argpartition(keys, max_num, axis=1)[:, :max_num]
+        else:
+            cand = np.broadcast_to(np.arange(mask.shape[1]), mask.shape)
+        # rank the few candidates of every row to cut each at its own count
+        cand = np.take_along_axis(cand, np.argsort(np.take_along_axis(keys, cand, axis=1), axis=1), axis=1)
+        keep = np.take_along_axis(mask, cand, axis=1) & (np.arange(cand.shape[1]) < nums[:, np.newaxis])
+        out = np.zeros_like(mask)
+        np.put_along_axis(out, cand, keep, axis=1)
+        return out
@@ -1,6 +1,4 @@
 import numpy as np
-from lib.nms.cpu_nms import cpu_soft_nms
-from lib.nms_deformable.nms import py_softnms_wrapper
 
 def bbox_flip(bbox, width, flip_x=False):
     """
@@ -19,26 +17,37 @@ def bbox_flip(bbox, width, flip_x=False):
     return bbox
 
 
-def bbox_overlaps(boxes, query_boxes):
+def bbox_overlaps(boxes, query_boxes, block_size=1 << 22):
     """
     determine overlaps between boxes and query_boxes
+    broadcast over blocks of boxes so that each temporary holds at most block_size elements
     :param boxes: n * 4 bounding boxes
     :param query_boxes: k * 4 bounding boxes
+    :param block_size: max number of (box, query_box) pairs computed at once, bounds peak memory
     :return: overlaps: n * k overlaps
     """
     n_ = boxes.shape[0]
     k_ = query_boxes.shape[0]
-    overlaps = np.zeros((n_, k_), dtype=np.float)
-    for k in range(k_):
-        query_box_area = (query_boxes[k, 2] - query_boxes[k, 0] + 1) * (query_boxes[k, 3] - query_boxes[k, 1] + 1)
-        for n in range(n_):
-            iw = min(boxes[n, 2], query_boxes[k, 2]) - max(boxes[n, 0], query_boxes[k, 0]) + 1
-            if iw > 0:
-                ih = min(boxes[n, 3], query_boxes[k, 3]) - max(boxes[n, 1], query_boxes[k, 1]) + 1
-                if ih > 0:
-                    box_area = (boxes[n, 2] - boxes[n, 0] + 1) * (boxes[n, 3] - boxes[n, 1] + 1)
-                    all_area = float(box_area + query_box_area - iw * ih)
-                    overlaps[n, k] = iw * ih / all_area
+    overlaps = np.zeros((n_, k_), dtype=np.float64)
+    if n_ == 0 or k_ == 0:
+        return overlaps
+
+    boxes = boxes[:, :4].astype(np.float64, copy=False)
+    query_boxes = query_boxes[:, :4].astype(np.float64, copy=False)
+    box_areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    query_box_areas = (query_boxes[:, 2] - query_boxes[:, 0] + 1) * (query_boxes[:, 3] - query_boxes[:, 1] + 1)
+
+    step = max(1, block_size // k_)
+    for start in range(0, n_, step):
+        end = min(start + step, n_)
+        b = boxes[start:end]
+        iw = np.minimum(b[:, 2:3], query_boxes[:, 2]) - np.maximum(b[:, 0:1], query_boxes[:, 0]) + 1
+        ih = np.minimum(b[:, 3:4], query_boxes[:, 3]) - np.maximum(b[:, 1:2], query_boxes[:, 1]) + 1
+        # only pairs with positive width and height intersect, the rest stay 0
+        valid = (iw > 0) & (ih > 0)
+        inters = iw * ih
+        all_area = box_areas[start:end, np.newaxis] + query_box_areas - inters
+        np.divide(inters, all_area, out=overlaps[start:end], where=valid)
     return overlaps
 
 
@@ -142,7 +151,8 @@ def nms(dets, thresh):
     scores = dets[:, 4]
 
     areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    order = scores.argsort()[::-1]
+    # stable descending order, ties keep input order
+    order = np.argsort(-scores, kind='mergesort')
 
     keep = []
     while order.size > 0:
@@ -164,24 +174,152 @@ def nms(dets, thresh):
     return keep
 
 
-# def soft_nms(dets, sigma=0.5, Nt=0.3, threshold=0.001, method=1):
-#
-#     keep = cpu_soft_nms(np.ascontiguousarray(dets, dtype=np.float32),
-#                         np.float32(sigma), np.float32(Nt),
-#                         np.float32(threshold),
-#                         np.uint8(method))
-#     return keep
+def _class_grid(boxes, scores, classes):
+    """
+    lay boxes out as a [class, rank] grid sorted by descending score, ties keep input order
+    :return: order, (class, rank) position of order, boxes grid, scores grid, valid mask, areas grid
+    """
+    order = np.lexsort((-scores, classes))
+    class_ids, class_inds = np.unique(classes[order], return_inverse=True)
+    counts = np.bincount(class_inds)
+    rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    grid = np.zeros((len(class_ids), counts.max(), 4), dtype=np.float64)
+    grid[class_inds, rank] = boxes[order]
+    score_grid = np.zeros(grid.shape[:2], dtype=np.float64)
+    score_grid[class_inds, rank] = scores[order]
+    valid = np.zeros(grid.shape[:2], dtype=bool)
+    valid[class_inds, rank] = True
+    areas = (grid[:, :, 2] - grid[:, :, 0] + 1) * (grid[:, :, 3] - grid[:, :, 1] + 1)
+    return order, (class_inds, rank), grid, score_grid, valid, areas
+
+
+def _grid_overlaps(grid, areas, rows, first):
+    """overlaps between box first of every row in rows and all boxes of that row"""
+    top = grid[rows, first][:, np.newaxis, :]
+    cand = grid[rows]
+    w = np.maximum(0.0, np.minimum(top[:, :, 2], cand[:, :, 2]) - np.maximum(top[:, :, 0], cand[:, :, 0]) + 1)
+    h = np.maximum(0.0, np.minimum(top[:, :, 3], cand[:, :, 3]) - np.maximum(top[:, :, 1], cand[:, :, 1]) + 1)
+    inter = w * h
+    return inter / (areas[rows, first][:, np.newaxis] + areas[rows] - inter)
+
+
+def multiclass_nms(boxes, scores, classes, thresh):
+    """
+    greedy nms of every class in one pass, same result as nms on each class separately
+    classes advance in lockstep: each step keeps the best remaining box of every class at once,
+    so the number of steps is the largest number of boxes kept in any class
+    :param boxes: [N, 4]
+    :param scores: [N]
+    :param classes: [N] class id of each box
+    :param thresh: retain overlap <= thresh within a class
+    :return: indexes to keep, ordered by class then descending score
+    """
+    if boxes.shape[0] == 0:
+        return np.zeros((0,), dtype=np.int64)
+
+    order, pos, grid, _, alive, areas = _class_grid(boxes, scores, classes)
+    keep = np.zeros(grid.shape[:2], dtype=bool)
+
+    rows = np.where(alive.any(axis=1))[0]
+    while rows.size > 0:
+        # best remaining box of every class with boxes left
+        first = alive[rows].argmax(axis=1)
+        keep[rows, first] = True
+        alive[rows, first] = False
+        ovr = _grid_overlaps(grid, areas, rows, first)
+        alive[rows] &= ovr <= thresh
+        rows = rows[alive[rows].any(axis=1)]
+
+    # order is sorted by class then rank already
+    return order[keep[pos]]
+
+
+def multiclass_soft_nms(boxes, scores, classes, method='gaussian', sigma=0.5, Nt=0.3, threshold=0.001):
+    """
+    soft-nms (Bodla et al. 2017) of every class in one pass, classes advance in lockstep
+    each step keeps the highest scoring remaining box of every class and decays the scores
+    of the other boxes of that class by their overlap with it
+    :param boxes: [N, 4]
+    :param scores: [N]
+    :param classes: [N] class id of each box
+    :param method: 'linear' scales by 1 - overlap above Nt, 'gaussian' by exp(-overlap^2 / sigma),
+                   'hard' drops overlap above Nt like nms
+    :param sigma: gaussian decay width
+    :param Nt: overlap threshold of linear and hard decay
+    :param threshold: boxes whose decayed score falls below threshold are discarded
+    :return: indexes to keep ordered by class then selection, decayed scores of kept boxes
+    """
+    if boxes.shape[0] == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.float64)
+    assert method in ('linear', 'gaussian', 'hard'), 'unknown soft nms method {}'.format(method)
+
+    order, pos, grid, score_grid, alive, areas = _class_grid(boxes, scores, classes)
+    step = np.full(grid.shape[:2], -1, dtype=np.int64)
+
+    rows = np.where(alive.any(axis=1))[0]
+    cur = 0
+    while rows.size > 0:
+        # scores change as they decay, so search the best remaining box every step
+        first = np.where(alive[rows], score_grid[rows], -np.inf).argmax(axis=1)
+        step[rows, first] = cur
+        alive[rows, first] = False
+        ovr = _grid_overlaps(grid, areas, rows, first)
+        if method == 'linear':
+            weight = np.where(ovr > Nt, 1 - ovr, 1)
+        elif method == 'gaussian':
+            weight = np.exp(-(ovr * ovr) / sigma)
+        else:
+            weight = (ovr <= Nt).astype(np.float64)
+        # only remaining boxes decay, kept boxes keep their score
+        score_grid[rows] *= np.where(alive[rows], weight, 1)
+        # only decayed, i.e. overlapping boxes are checked against threshold
+        alive[rows] &= (ovr <= 0) | (score_grid[rows] >= threshold)
+        rows = rows[alive[rows].any(axis=1)]
+        cur += 1
+
+    # kept boxes by class then selection step
+    class_inds, rank = pos
+    kept = np.where(step[pos] >= 0)[0]
+    kept = kept[np.lexsort((step[class_inds[kept], rank[kept]], class_inds[kept]))]
+    return order[kept], score_grid[class_inds[kept], rank[kept]]
+
+
+def soft_nms(dets, method='gaussian', sigma=0.5, Nt=0.3, threshold=0.001):
+    """
+    soft-nms of one class
+    :param dets: [[x1, y1, x2, y2 score]]
+    :return: indexes to keep in selection order, decayed scores of kept dets
+    """
+    return multiclass_soft_nms(dets[:, :4], dets[:, 4], np.zeros((dets.shape[0],), dtype=np.int64),
+                               method=method, sigma=sigma, Nt=Nt, threshold=threshold)
+
+
+def cap_detections(det, max_per_image):
+    """
+    keep the max_per_image highest scoring detections of all classes
+    :param det: [N, 6] (cls, score, x1, y1, x2, y2)
+    :param max_per_image: cap, 0 or less disables it
+    :return: kept det in original order, number of pruned detections
+    """
+    num_det = det.shape[0]
+    if max_per_image <= 0 or num_det <= max_per_image:
+        return det, 0
+    keep = np.argpartition(-det[:, 1], max_per_image - 1)[:max_per_image]
+    return det[np.sort(keep)], num_det - max_per_image
 
 
 def im_detect(rois, scores, bbox_deltas, im_info,
               bbox_stds, nms_thresh, conf_thresh, 
-              use_soft_nms, soft_nms_thresh, max_per_image=100):
-    """rois (nroi, 4), scores (nrois, nclasses), bbox_deltas (nrois, 4 * nclasses), im_info (3)"""
-    rois = rois.asnumpy()
-    scores = scores.asnumpy()
-    bbox_deltas = bbox_deltas.asnumpy()
-
-    im_info = im_info.asnumpy()
+              use_soft_nms, soft_nms_thresh, max_per_image=100, batched_nms=True, soft_nms_method='gaussian',
+              return_pruned=False):
+    """rois (nroi, 4), scores (nrois, nclasses), bbox_deltas (nrois, 4 * nclasses), im_info (3)
+    inputs are NDArray or numpy array
+    batched_nms suppresses all classes in one pass with multiclass_nms, same result as per class nms
+    use_soft_nms decays scores with multiclass_soft_nms instead, soft_nms_thresh is sigma of gaussian
+    or overlap threshold of linear decay, boxes decayed below conf_thresh are dropped
+    at most max_per_image detections of all classes are kept, return_pruned also returns how many were dropped"""
+    rois, scores, bbox_deltas, im_info = [x.asnumpy() if hasattr(x, 'asnumpy') else x
+                                          for x in (rois, scores, bbox_deltas, im_info)]
     height, width, scale = im_info
 
     # post processing
@@ -191,36 +329,39 @@ def im_detect(rois, scores, bbox_deltas, im_info,
     # we used scaled image & roi to train, so it is necessary to transform them back
     pred_boxes = pred_boxes / scale
 
-    # convert to per class detection results
-    det = []
-    for j in range(1, scores.shape[-1]):
-        indexes = np.where(scores[:, j] > conf_thresh)[0]
-        cls_scores = scores[indexes, j, np.newaxis]
-        cls_boxes = pred_boxes[indexes, j * 4:(j + 1) * 4]
-        cls_dets = np.hstack((cls_boxes, cls_scores))
-        # add soft_nms by liusm 20180929
+    if batched_nms or use_soft_nms:
+        # candidates of all foreground classes, class major like the per class loop
+        cls_inds, roi_inds = np.where(scores[:, 1:].T > conf_thresh)
+        cls_inds += 1
+        cls_scores = scores[roi_inds, cls_inds]
+        cls_boxes = pred_boxes.reshape((pred_boxes.shape[0], scores.shape[1], 4))[roi_inds, cls_inds]
         if use_soft_nms:
-            # soft_nms = py_softnms_wrapper(soft_nms_thresh, max_dets=max_per_image)
-            # keep_, all_boxes = soft_nms(cls_dets)
-            # # keep = nms(cls_dets, thresh=nms_thresh)
-            # if len(keep_):
-            #     if max_per_image > 0:
-            #         image_scores = np.hstack([all_boxes[j][..., -1] for j in range(all_boxes.shape[0])])
-            #         if len(image_scores) > max_per_image:
-            #             image_thresh = np.sort(image_scores)[-max_per_image]
-            #             for j in range(scores.shape[-1]):
-            #                 keep = np.where(all_boxes[j][:, -1] >= image_thresh)[0]
-            #         else:
-            #             keep = keep_
-            # else:
-            #     keep = keep_
-            keep = nms(cls_dets, thresh=nms_thresh)
+            keep, cls_scores = multiclass_soft_nms(cls_boxes, cls_scores, cls_inds, method=soft_nms_method,
+                                                   sigma=soft_nms_thresh, Nt=soft_nms_thresh, threshold=conf_thresh)
+            cls_scores = cls_scores.astype(scores.dtype)
         else:
+            keep = multiclass_nms(cls_boxes, cls_scores, cls_inds, nms_thresh)
+            cls_scores = cls_scores[keep]
+        det = np.hstack((cls_inds[keep, np.newaxis].astype(scores.dtype), cls_scores[:, np.newaxis],
+                         cls_boxes[keep]))
+    else:
+        # convert to per class detection results
+        det = []
+        for j in range(1, scores.shape[-1]):
+            indexes = np.where(scores[:, j] > conf_thresh)[0]
+            cls_scores = scores[indexes, j, np.newaxis]
+            cls_boxes = pred_boxes[indexes, j * 4:(j + 1) * 4]
+            cls_dets = np.hstack((cls_boxes, cls_scores))
             keep = nms(cls_dets, thresh=nms_thresh)
 
-        cls_id = np.ones_like(cls_scores) * j
-        det.append(np.hstack((cls_id, cls_scores, cls_boxes))[keep, :])
+            cls_id = np.ones_like(cls_scores) * j
+            det.append(np.hstack((cls_id, cls_scores, cls_boxes))[keep, :])
+
+        # assemble all classes
+        det = np.concatenate(det, axis=0)
 
-    # assemble all classes
-    det = np.concatenate(det, axis=0)
+    # cap detections of all classes by score, keeping class order
+    det, num_pruned = cap_detections(det, max_per_image)
+    if return_pruned:
+        return det, num_pruned
     return det
@@ -1,8 +1,10 @@
+import time
+
 import numpy as np
 import cv2
 
 
-def get_image(roi_rec, short, max_size, mean, std):
+def get_image(roi_rec, short, max_size, mean, std, flip=False, decoder=None):
     """
     read, resize, transform image, return im_tensor, im_info, gt_boxes
     roi_rec should have keys: ["image", "boxes", "gt_classes", "flipped"]
@@ -10,13 +12,33 @@ def get_image(roi_rec, short, max_size, mean, std):
     |
     y (height, first dim of im)
     """
-    im = imdecode(roi_rec['image'])
-    if roi_rec["flipped"]:
+    im, im_info, gt_boxes = load_image(roi_rec, short, max_size, flip, decoder)
+    im_tensor = transform(im, mean, std)
+    return im_tensor, im_info, gt_boxes
+
+
+def load_image(roi_rec, short, max_size, flip=False, decoder=None):
+    """
+    read and resize image, return BGR im, im_info, gt_boxes
+    transform is left to the caller so that im can be written into a batch buffer
+    roi_rec["boxes"] are in original image coordinates, image and boxes are flipped when loading
+    if roi_rec["flipped"] xor flip
+    roi_rec["image"] is an image path, decoder is an ImageDecoder, opencv at full resolution by default
+    """
+    decoder = decoder if decoder is not None else _default_decoder
+    flipped = roi_rec["flipped"] != flip
+    if decoder.reduce_factors == (1,):
+        im, _ = decoder(roi_rec['image'])
+        size = None
+    else:
+        # the size of a reduced image is rounded, scale is computed from the original size in roi_rec
+        size = (roi_rec['height'], roi_rec['width'])
+        im, _ = decoder(roi_rec['image'], get_scale(size[0], size[1], short, max_size))
+    if flipped:
         im = im[:, ::-1, :]
-    im, im_scale = resize(im, short, max_size)
+    im, im_scale = resize(im, short, max_size, size)
     height, width = im.shape[:2]
     im_info = np.array([height, width, im_scale], dtype=np.float32)
-    im_tensor = transform(im, mean, std)
 
     # gt boxes: (x1, y1, x2, y2, cls)
     if roi_rec['gt_classes'].size > 0:
@@ -24,54 +46,143 @@ def get_image(roi_rec, short, max_size, mean, std):
         gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
         gt_boxes[:, 0:4] = roi_rec['boxes'][gt_inds, :]
         gt_boxes[:, 4] = roi_rec['gt_classes'][gt_inds]
+        if flipped:
+            gt_boxes[:, [0, 2]] = roi_rec['width'] - gt_boxes[:, [2, 0]] - 1
         # scale gt_boxes
         gt_boxes[:, 0:4] *= im_scale
     else:
         gt_boxes = np.empty((0, 5), dtype=np.float32)
 
-    return im_tensor, im_info, gt_boxes
+    return im, im_info, gt_boxes
+
+
+class ImageDecoder:
+    """
+    decode an image path or encoded bytes into a BGR image with opencv at full resolution,
+    calls and seconds count the images decoded and the time spent on them
+    subclasses override decode and reduce_factors to plug in other backends
+    """
+    name = 'opencv'
+    # factors decode can shrink both sides by
+    reduce_factors = (1,)
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.
+
+    def __call__(self, image, scale=1.):
+        """
+        :param image: path or encoded bytes
+        :param scale: scale the image is going to be resized by, the image is reduced by the largest factor
+                      of reduce_factors that still leaves it at least that large
+        :return: BGR image, reduce factor
+        """
+        factor = max([f for f in self.reduce_factors if f * scale <= 1] + [1])
+        tic = time.time()
+        im = self.decode(image, factor)
+        self.seconds += time.time() - tic
+        self.calls += 1
+        return im, factor
+
+    def decode(self, image, factor):
+        flags = _REDUCED_FLAGS[factor]
+        if isinstance(image, str):
+            im = cv2.imread(image, flags)
+            assert im is not None, image + ' not found or not an image'
+        else:
+            im = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), flags)
+            assert im is not None, 'bytes are not an encoded image'
+        return im
+
+    def reset_stats(self):
+        """return calls, seconds since the last reset"""
+        stats = self.calls, self.seconds
+        self.calls, self.seconds = 0, 0.
+        return stats
+
+
+class ReducedImageDecoder(ImageDecoder):
+    """
+    decode jpegs at 1/2, 1/4 or 1/8 resolution by scaling in the DCT domain of libjpeg,
+    when resize is going to shrink them at least that much, so that resize starts from a smaller image
+    other formats are decoded at full resolution and downscaled by opencv
+    """
+    name = 'opencv-reduced'
+    reduce_factors = (1, 2, 4, 8)
+
+
+_REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                  4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+DECODERS = {ImageDecoder.name: ImageDecoder, ReducedImageDecoder.name: ReducedImageDecoder}
+
+_default_decoder = ImageDecoder()
+
 
+def get_decoder(name):
+    """new ImageDecoder of DECODERS by name"""
+    if name not in DECODERS:
+        raise ValueError("image decoder {} not supported".format(name))
+    return DECODERS[name]()
 
-def imdecode(image_path):
-    """Return BGR image read by opencv"""
-    import os
-    assert os.path.exists(image_path), image_path + ' not found'
-    im = cv2.imread(image_path)
+
+def imdecode(image):
+    """Return BGR image read by opencv from a path or encoded bytes"""
+    im, _ = _default_decoder(image)
     return im
 
 
-def resize(im, short, max_size):
+def resize(im, short, max_size, size=None):
     """
     only resize input image to target size and return scale
     :param im: BGR image input by opencv
     :param short: one dimensional size (the short side)
     :param max_size: one dimensional max size (the long side)
+    :param size: original (height, width) of an im decoded at reduced size, the scale is relative to it
     :return: resized image (NDArray) and scale (float)
     """
-    im_shape = im.shape
-    im_size_min = np.min(im_shape[0:2])
-    im_size_max = np.max(im_shape[0:2])
+    if size is None:
+        im_scale = get_scale(im.shape[0], im.shape[1], short, max_size)
+        im = cv2.resize(im, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
+    else:
+        im_scale = get_scale(size[0], size[1], short, max_size)
+        # same rounding as the size opencv derives from fx and fy
+        dsize = (int(round(size[1] * im_scale)), int(round(size[0] * im_scale)))
+        im = cv2.resize(im, dsize, interpolation=cv2.INTER_LINEAR)
+    return im, im_scale
+
+
+def get_scale(height, width, short, max_size):
+    """scale applied by resize to an image of height and width"""
+    im_size_min = min(height, width)
+    im_size_max = max(height, width)
     im_scale = float(short) / float(im_size_min)
     # prevent bigger axis from being more than max_size:
     if np.round(im_scale * im_size_max) > max_size:
         im_scale = float(max_size) / float(im_size_max)
-    im = cv2.resize(im, None, None, fx=im_scale, fy=im_scale, interpolation=cv2.INTER_LINEAR)
-    return im, im_scale
+    return im_scale
 
 
-def transform(im, mean, std):
+def transform(im, mean, std, out=None):
     """
     transform into mxnet tensor,
     subtract pixel size and transform to correct format
+    BGR to RGB, mean, std and HWC to CHW are applied while writing float32 output
     :param im: [height, width, channel] in BGR
     :param mean: [RGB pixel mean]
     :param std: [RGB pixel std var]
-    :return: [batch, channel, height, width]
+    :param out: optional float32 [channel, height, width] to write into, e.g. a slice of a batch buffer
+    :return: [channel, height, width]
     """
-    im_tensor = np.zeros((3, im.shape[0], im.shape[1]))
-    for i in range(3):
-        im_tensor[i, :, :] = (im[:, :, 2 - i] - mean[i]) / std[i]
-    return im_tensor
+    if out is None:
+        out = np.empty((3, im.shape[0], im.shape[1]), dtype=np.float32)
+    assert out.shape == (3, im.shape[0], im.shape[1]), 'out shape {} mismatch image {}'.format(out.shape, im.shape)
+    # reversed channel and transposed view of im, no copy until written into out
+    im_rgb = im[:, :, ::-1].transpose((2, 0, 1))
+    np.subtract(im_rgb, np.asarray(mean, dtype=np.float32).reshape((3, 1, 1)), out=out, casting='unsafe')
+    if np.any(np.asarray(std) != 1):
+        np.divide(out, np.asarray(std, dtype=np.float32).reshape((3, 1, 1)), out=out)
+    return out
 
 
 def transform_inverse(im_tensor, mean, std):
@@ -90,15 +201,16 @@ def transform_inverse(im_tensor, mean, std):
     return im
 
 
-def tensor_vstack(tensor_list, pad=0):
+def tensor_vstack(tensor_list, pad=0, out=None):
     """
     vertically stack tensors by adding a new axis
     expand dims if only 1 tensor
     :param tensor_list: list of tensor to be stacked vertically
     :param pad: label to pad with
+    :param out: optional array of the stacked shape to write into, its old content is overwritten
     :return: tensor with max shape
     """
-    if len(tensor_list) == 1:
+    if len(tensor_list) == 1 and out is None:
         return tensor_list[0][np.newaxis, :]
 
     ndim = len(tensor_list[0].shape)
@@ -106,22 +218,53 @@ def tensor_vstack(tensor_list, pad=0):
     for dim in range(ndim):
         dimensions.append(max([tensor.shape[dim] for tensor in tensor_list]))
 
-    dtype = tensor_list[0].dtype
-    if pad == 0:
-        all_tensor = np.zeros(tuple(dimensions), dtype=dtype)
-    elif pad == 1:
-        all_tensor = np.ones(tuple(dimensions), dtype=dtype)
-    else:
-        all_tensor = np.full(tuple(dimensions), pad, dtype=dtype)
-    if ndim == 1:
-        for ind, tensor in enumerate(tensor_list):
-            all_tensor[ind, :tensor.shape[0]] = tensor
-    elif ndim == 2:
-        for ind, tensor in enumerate(tensor_list):
-            all_tensor[ind, :tensor.shape[0], :tensor.shape[1]] = tensor
-    elif ndim == 3:
-        for ind, tensor in enumerate(tensor_list):
-            all_tensor[ind, :tensor.shape[0], :tensor.shape[1], :tensor.shape[2]] = tensor
+    if out is None:
+        dtype = tensor_list[0].dtype
+        if pad == 0:
+            all_tensor = np.zeros(tuple(dimensions), dtype=dtype)
+        elif pad == 1:
+            all_tensor = np.ones(tuple(dimensions), dtype=dtype)
+        else:
+            all_tensor = np.full(tuple(dimensions), pad, dtype=dtype)
     else:
-        raise Exception('Sorry, unimplemented.')
+        assert out.shape == tuple(dimensions), 'out shape {} mismatch {}'.format(out.shape, dimensions)
+        all_tensor = out
+    for ind, tensor in enumerate(tensor_list):
+        all_tensor[(ind,) + tuple(slice(0, d) for d in tensor.shape)] = tensor
+        if out is not None:
+            fill_padding(all_tensor[ind], tensor.shape, pad)
     return all_tensor
+
+
+def fill_padding(tensor, shape, pad=0):
+    """set everything of tensor outside the leading [:shape[0], :shape[1], ...] block to pad"""
+    for dim in range(len(shape)):
+        if shape[dim] < tensor.shape[dim]:
+            index = tuple(slice(0, d) for d in shape[:dim]) + (slice(shape[dim], None),)
+            tensor[index] = pad
+
+
+class BatchBuffer:
+    """
+    named batch arrays reused across iterations
+    storage is flat and only reallocated when a batch needs more elements than any batch before,
+    so views returned by get are valid until the next get of the same name
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype=np.float32):
+        """uninitialized array of shape backed by the buffer called name"""
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < size:
+            buf = np.empty((size,), dtype=dtype)
+            self._buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+    def stack(self, name, tensor_list, pad=0):
+        """tensor_vstack into the buffer called name"""
+        ndim = len(tensor_list[0].shape)
+        shape = (len(tensor_list),) + tuple(max([tensor.shape[dim] for tensor in tensor_list]) for dim in range(ndim))
+        out = self.get(name, shape, dtype=tensor_list[0].dtype)
+        return tensor_vstack(tensor_list, pad=pad, out=out)
@@ -1,8 +1,11 @@
 import mxnet as mx
 import numpy as np
 
-from symdata.anchor import AnchorGenerator, AnchorSampler
-from symdata.image import imdecode, resize, transform, get_image, tensor_vstack
+from symdata.anchor import AnchorGenerator, AnchorSampler, LRUCache
+from symdata.image import imdecode, resize, transform, load_image, fill_padding, BatchBuffer, ImageDecoder
+from symdata.prefetch import Prefetcher
+from symdata.sampler import AspectRatioSampler
+from symnet.logger import logger
 
 
 def load_test(filename, short, max_size, mean, std):
@@ -32,8 +35,19 @@ def generate_batch(im_tensor, im_info):
     return data_batch
 
 
+def stack_images(buffers, ims, mean, std):
+    """transform BGR images straight into the padded (batch, 3, height, width) buffer 'data'"""
+    height = max([im.shape[0] for im in ims])
+    width = max([im.shape[1] for im in ims])
+    im_tensor = buffers.get('data', (len(ims), 3, height, width))
+    for ind, im in enumerate(ims):
+        transform(im, mean, std, out=im_tensor[ind, :, :im.shape[0], :im.shape[1]])
+        fill_padding(im_tensor[ind], (3,) + im.shape[:2], 0)
+    return im_tensor
+
+
 class TestLoader(mx.io.DataIter):
-    def __init__(self, roidb, batch_size, short, max_size, mean, std):
+    def __init__(self, roidb, batch_size, short, max_size, mean, std, num_workers=0, prefetch=4, decoder=None):
         super(TestLoader, self).__init__()
 
         # save parameters as properties
@@ -43,6 +57,7 @@ class TestLoader(mx.io.DataIter):
         self._max_size = max_size
         self._mean = mean
         self._std = std
+        self._decoder = decoder if decoder is not None else ImageDecoder()
 
         # infer properties from roidb
         self._size = len(self._roidb)
@@ -54,10 +69,17 @@ class TestLoader(mx.io.DataIter):
 
         # status variable
         self._cur = 0
+        self._submitted = 0
         self._data = None
         self._label = None
+        self._buffers = BatchBuffer()
+
+        # prefetch workers write batches to shared memory, they are started by reset
+        self._num_workers = num_workers
+        self._prefetch = prefetch
+        self._prefetcher = None
 
-        # get first batch to fill in provide_data and provide_label
+        # get first batch to fill in provide_data and provide_label, loaded serially
         self.next()
         self.reset()
 
@@ -69,14 +91,31 @@ class TestLoader(mx.io.DataIter):
     def provide_label(self):
         return None
 
+    @property
+    def decoder(self):
+        """ImageDecoder, its stats include images decoded by prefetch workers"""
+        return self._decoder
+
+    @property
+    def caches(self):
+        """LRUCaches used by load_batch, their stats include lookups of prefetch workers"""
+        return ()
+
     def reset(self):
+        if self._prefetcher is not None:
+            self._prefetcher.clear()
+        elif self._num_workers > 0:
+            slot_bytes = 4 * self._batch_size * (3 * self._max_size * self._max_size + 3) + 1024
+            self._prefetcher = Prefetcher(self, self._num_workers, self._prefetch, slot_bytes)
         self._cur = 0
+        self._submitted = 0
 
     def iter_next(self):
-        return self._cur + self._batch_size <= self._size
+        return self._cur < self._size
 
     def next(self):
         if self.iter_next():
+            self._data = self._next_batch()
             data_batch = mx.io.DataBatch(data=self.getdata(), label=self.getlabel(),
                                          pad=self.getpad(), index=self.getindex(),
                                          provide_data=self.provide_data, provide_label=self.provide_label)
@@ -85,17 +124,39 @@ class TestLoader(mx.io.DataIter):
         else:
             raise StopIteration
 
-    def getdata(self):
-        indices = self.getindex()
-        im_tensor, im_info = [], []
+    def _batch_indices(self, cur):
+        """roidb indexes of the batch starting at cur, the last batch is padded by repeating its images"""
+        return np.resize(self._index[cur:cur + self._batch_size], self._batch_size)
+
+    def _next_batch(self):
+        if self._prefetcher is None:
+            data, _ = self.load_batch(self._batch_indices(self._cur))
+            return [mx.nd.array(x) for x in data]
+
+        while self._prefetcher.can_submit() and self._submitted < self._size:
+            self._prefetcher.submit(self._batch_indices(self._submitted), None)
+            self._submitted += self._batch_size
+        slot, arrays = self._prefetcher.get()
+        data = [mx.nd.array(x) for x in arrays]
+        self._prefetcher.release(slot)
+        return data
+
+    def load_batch(self, indices, rng=None):
+        """
+        read images of roidb[indices]
+        :return: (im_tensor, im_info), () as numpy arrays, reused by the next call
+        """
+        ims, im_info = [], []
         for index in indices:
             roi_rec = self._roidb[index]
-            b_im_tensor, b_im_info, _ = get_image(roi_rec, self._short, self._max_size, self._mean, self._std)
-            im_tensor.append(b_im_tensor)
+            b_im, b_im_info, _ = load_image(roi_rec, self._short, self._max_size, decoder=self._decoder)
+            ims.append(b_im)
             im_info.append(b_im_info)
-        im_tensor = mx.nd.array(tensor_vstack(im_tensor, pad=0))
-        im_info = mx.nd.array(tensor_vstack(im_info, pad=0))
-        self._data = im_tensor, im_info
+        im_tensor = stack_images(self._buffers, ims, self._mean, self._std)
+        im_info = self._buffers.stack('im_info', im_info, pad=0)
+        return (im_tensor, im_info), ()
+
+    def getdata(self):
         return self._data
 
     def getlabel(self):
@@ -107,13 +168,24 @@ class TestLoader(mx.io.DataIter):
         return np.arange(cur_from, cur_to)
 
     def getpad(self):
-        return max(self._cur + self.batch_size - self._size, 0)
+        return max(self._cur + self._batch_size - self._size, 0)
+
+    def close(self):
+        """stop prefetch workers, they are not restarted by reset"""
+        self._num_workers = 0
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def __del__(self):
+        self.close()
 
 
 class AnchorLoader(mx.io.DataIter):
     def __init__(self, roidb, batch_size, short, max_size, mean, std,
                  feat_sym, anchor_generator: AnchorGenerator, anchor_sampler: AnchorSampler,
-                 shuffle=False):
+                 shuffle=False, num_workers=0, prefetch=4, seed=None, aspect_grouping=False, random_flip=False,
+                 decoder=None):
         super(AnchorLoader, self).__init__()
 
         # save parameters as properties
@@ -127,6 +199,10 @@ class AnchorLoader(mx.io.DataIter):
         self._ag = anchor_generator
         self._as = anchor_sampler
         self._shuffle = shuffle
+        self._seed = seed
+        self._random_flip = random_flip
+        self._decoder = decoder if decoder is not None else ImageDecoder()
+        self._feat_shape_cache = LRUCache(capacity=64)
 
         # infer properties from roidb
         self._size = len(roidb)
@@ -138,10 +214,28 @@ class AnchorLoader(mx.io.DataIter):
 
         # status variable
         self._cur = 0
+        self._submitted = 0
+        self._epoch = 0
         self._data = None
         self._label = None
+        self._buffers = BatchBuffer()
+
+        # a fixed seed makes shuffling and anchor sampling reproducible, with or without workers
+        self._rng = np.random.RandomState(seed) if seed is not None else np.random
+
+        # batch images of similar aspect ratio together to reduce padding
+        self._sampler = None
+        if aspect_grouping:
+            self._sampler = AspectRatioSampler(roidb, batch_size, short, max_size)
+            self._index = self._sampler.sample()
+
+        # prefetch workers are forked, so they share roidb and symbol without pickling,
+        # and write batches to shared memory, they are started by reset
+        self._num_workers = num_workers
+        self._prefetch = prefetch
+        self._prefetcher = None
 
-        # get first batch to fill in provide_data and provide_label
+        # get first batch to fill in provide_data and provide_label, loaded serially
         self.next()
         self.reset()
 
@@ -153,16 +247,48 @@ class AnchorLoader(mx.io.DataIter):
     def provide_label(self):
         return [(k, v.shape) for k, v in zip(self._label_name, self._label)]
 
+    @property
+    def feat_shape_cache(self):
+        return self._feat_shape_cache
+
+    @property
+    def decoder(self):
+        """ImageDecoder, its stats include images decoded by prefetch workers"""
+        return self._decoder
+
+    @property
+    def caches(self):
+        """LRUCaches used by load_batch, their stats include lookups of prefetch workers"""
+        return self._ag.cache, self._as.cache, self._feat_shape_cache
+
     def reset(self):
+        if self._cur > 0:
+            logger.info('anchor cache {}, inside anchor cache {}, feature shape cache {}'.format(
+                self._ag.cache, self._as.cache, self._feat_shape_cache))
+            calls, seconds = self._decoder.reset_stats()
+            logger.info('{} decoded {} images at {:.2f} ms per image'.format(
+                self._decoder.name, calls, 1e3 * seconds / max(calls, 1)))
+        # batches prefetched for the last epoch are dropped
+        if self._prefetcher is not None:
+            self._prefetcher.clear()
+        elif self._num_workers > 0:
+            self._prefetcher = Prefetcher(self, self._num_workers, self._prefetch, self._max_batch_bytes())
         self._cur = 0
-        if self._shuffle:
-            np.random.shuffle(self._index)
+        self._submitted = 0
+        self._epoch += 1
+        if self._sampler is not None:
+            self._index = self._sampler.sample(self._rng if self._shuffle else None)
+            logger.info('padding waste {:.1%} with aspect ratio grouping, {:.1%} in roidb order'.format(
+                self._sampler.padding_waste(self._index), self._sampler.padding_waste(np.arange(self._size))))
+        elif self._shuffle:
+            self._rng.shuffle(self._index)
 
     def iter_next(self):
         return self._cur + self._batch_size <= self._size
 
     def next(self):
         if self.iter_next():
+            self._data, self._label = self._next_batch()
             data_batch = mx.io.DataBatch(data=self.getdata(), label=self.getlabel(),
                                          pad=self.getpad(), index=self.getindex(),
                                          provide_data=self.provide_data, provide_label=self.provide_label)
@@ -172,50 +298,88 @@ class AnchorLoader(mx.io.DataIter):
             raise StopIteration
 
     def getdata(self):
-        indices = self.getindex()
-        im_tensor, im_info, gt_boxes = [], [], []
-        for index in indices:
-            roi_rec = self._roidb[index]
-            b_im_tensor, b_im_info, b_gt_boxes = get_image(roi_rec, self._short, self._max_size, self._mean, self._std)
-            im_tensor.append(b_im_tensor)
-            im_info.append(b_im_info)
-            gt_boxes.append(b_gt_boxes)
-        im_tensor = mx.nd.array(tensor_vstack(im_tensor, pad=0))
-        im_info = mx.nd.array(tensor_vstack(im_info, pad=0))
-        gt_boxes = mx.nd.array(tensor_vstack(gt_boxes, pad=-1))
-        self._data = im_tensor, im_info, gt_boxes
         return self._data
 
     def getlabel(self):
-        im_tensor, im_info, gt_boxes = self._data
-
-        # all stacked image share same anchors
-        _, out_shape, _ = self._feat_sym.infer_shape(data=im_tensor.shape)
-        feat_height, feat_width = out_shape[0][-2:]
-        anchors = self._ag.generate(feat_height, feat_width)
-
-        # assign anchor according to their real size encoded in im_info
-        label, bbox_target, bbox_weight = [], [], []
-        for batch_ind in range(im_info.shape[0]):
-            b_im_info = im_info[batch_ind].asnumpy()
-            b_gt_boxes = gt_boxes[batch_ind].asnumpy()
-            b_im_height, b_im_width = b_im_info[:2]
-
-            b_label, b_bbox_target, b_bbox_weight = self._as.assign(anchors, b_gt_boxes, b_im_height, b_im_width)
+        return self._label
 
-            b_label = b_label.reshape((feat_height, feat_width, -1)).transpose((2, 0, 1)).flatten()
-            b_bbox_target = b_bbox_target.reshape((feat_height, feat_width, -1)).transpose((2, 0, 1))
-            b_bbox_weight = b_bbox_weight.reshape((feat_height, feat_width, -1)).transpose((2, 0, 1))
+    def _batch_seed(self, cur):
+        """seed of the batch starting at cur, None means the global numpy random state"""
+        if self._seed is not None:
+            return [self._seed, self._epoch, cur]
+        if self._prefetcher is not None:
+            return np.random.randint(0, 2 ** 31 - 1)
+        return None
 
-            label.append(b_label)
-            bbox_target.append(b_bbox_target)
-            bbox_weight.append(b_bbox_weight)
+    def _next_batch(self):
+        num_data = len(self._data_name)
+        if self._prefetcher is None:
+            seed = self._batch_seed(self._cur)
+            rng = np.random.RandomState(seed) if seed is not None else np.random
+            data, label = self.load_batch(self._index[self._cur:self._cur + self._batch_size], rng)
+            return [mx.nd.array(x) for x in data], [mx.nd.array(x) for x in label]
+
+        # keep up to prefetch batches in flight, results come back in submission order
+        while self._prefetcher.can_submit() and self._submitted + self._batch_size <= self._size:
+            indices = self._index[self._submitted:self._submitted + self._batch_size]
+            self._prefetcher.submit(indices, self._batch_seed(self._submitted))
+            self._submitted += self._batch_size
+        slot, arrays = self._prefetcher.get()
+        # mx.nd.array copies synchronously, the slot can be recycled right after
+        arrays = [mx.nd.array(x) for x in arrays]
+        self._prefetcher.release(slot)
+        return arrays[:num_data], arrays[num_data:]
+
+    def load_batch(self, indices, rng=np.random):
+        """
+        read images and assign anchors for roidb[indices]
+        :param indices: roidb indexes in this batch
+        :param rng: random state used for random flipping and anchor sampling
+        :return: (im_tensor, im_info, gt_boxes), (label, bbox_target, bbox_weight) as numpy arrays,
+                 reused by the next call
+        """
+        ims, im_info, gt_boxes = [], [], []
+        flips = rng.random_sample(len(indices)) < 0.5 if self._random_flip else np.zeros(len(indices), dtype=bool)
+        for index, flip in zip(indices, flips):
+            roi_rec = self._roidb[index]
+            b_im, b_im_info, b_gt_boxes = load_image(roi_rec, self._short, self._max_size, flip, self._decoder)
+            ims.append(b_im)
+            im_info.append(b_im_info)
+            gt_boxes.append(b_gt_boxes)
+        im_tensor = stack_images(self._buffers, ims, self._mean, self._std)
+        im_info = self._buffers.stack('im_info', im_info, pad=0)
+        gt_boxes = self._buffers.stack('gt_boxes', gt_boxes, pad=-1)
 
-        label = mx.nd.array(tensor_vstack(label, pad=-1))
-        bbox_target = mx.nd.array(tensor_vstack(bbox_target, pad=0))
-        bbox_weight = mx.nd.array(tensor_vstack(bbox_weight, pad=0))
-        self._label = label, bbox_target, bbox_weight
-        return self._label
+        # all stacked image share same anchors
+        feat_height, feat_width = self._feat_shape(im_tensor.shape)
+        anchors = self._ag.generate(feat_height, feat_width)
+        num_batch = len(ims)
+        num_anchors = anchors.shape[0]
+        A = self._ag.num_anchors
+
+        # assign anchor according to their real size encoded in im_info, written in (A, H, W) order
+        label = self._buffers.get('label', (num_batch, num_anchors))
+        bbox_target = self._buffers.get('bbox_target', (num_batch, 4 * A, feat_height, feat_width))
+        bbox_weight = self._buffers.get('bbox_weight', (num_batch, 4 * A, feat_height, feat_width))
+        self._as.assign_batch(anchors, gt_boxes, im_info[:, 0], im_info[:, 1], (feat_height, feat_width), rng=rng,
+                              out=(label, bbox_target, bbox_weight))
+
+        return (im_tensor, im_info, gt_boxes), (label, bbox_target, bbox_weight)
+
+    def _feat_shape(self, data_shape):
+        """feature height and width only depend on input height and width"""
+        def _infer():
+            _, out_shape, _ = self._feat_sym.infer_shape(data=tuple(data_shape))
+            return tuple(out_shape[0][-2:])
+        return self._feat_shape_cache.get(tuple(data_shape[-2:]), _infer)
+
+    def _max_batch_bytes(self):
+        """upper bound of float32 batch size, images are at most max_size on both sides"""
+        feat_height, feat_width = self._feat_shape((self._batch_size, 3, self._max_size, self._max_size))
+        max_gt = max(int(self._roidb.num_boxes.max(initial=0)), 1)
+        num_floats = 3 * self._max_size * self._max_size + 3 + max_gt * 5 + \
+            self._ag.num_anchors * feat_height * feat_width * 9
+        return 4 * self._batch_size * num_floats + 1024
 
     def getindex(self):
         cur_from = self._cur
@@ -223,4 +387,14 @@ class AnchorLoader(mx.io.DataIter):
         return np.arange(cur_from, cur_to)
 
     def getpad(self):
-        return max(self._cur + self.batch_size - self._size, 0)
+        return max(self._cur + self._batch_size - self._size, 0)
+
+    def close(self):
+        """stop prefetch workers, they are not restarted by reset"""
+        self._num_workers = 0
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def __del__(self):
+        self.close()
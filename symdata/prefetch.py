@@ -0,0 +1,153 @@
+"""
+Prefetch batches in forked worker processes.
+
+Workers write every batch array as float32 into one slot of a ring of preallocated shared memory,
+the consumer wraps the slot without copy, builds NDArrays from it, then releases the slot explicitly.
+A slot is only handed to a new batch after its previous batch has been released.
+"""
+
+import collections
+import mmap
+import multiprocessing
+
+import numpy as np
+
+from symnet.logger import logger
+
+# state shared with forked workers, set by _init_worker
+_worker_loader = None
+_worker_ring = None
+
+# byte alignment of every array written into a slot
+_ALIGN = 64
+
+
+def _init_worker(loader, ring):
+    global _worker_loader, _worker_ring
+    _worker_loader = loader
+    _worker_ring = ring
+    # stats counted by the consumer before fork are not sent back again
+    loader.decoder.reset_stats()
+    for cache in loader.caches:
+        cache.reset_stats()
+
+
+def _worker_load_batch(indices, seed, slot):
+    data, label = _worker_loader.load_batch(indices, np.random.RandomState(seed))
+    # decode and cache stats of this batch are added to the decoder and caches of the consumer
+    stats = _worker_loader.decoder.reset_stats(), [cache.reset_stats() for cache in _worker_loader.caches]
+    arrays = list(data) + list(label)
+    layout = _worker_ring.write(slot, arrays)
+    if layout is not None:
+        return layout, None, stats
+    # batch too large for a slot, send arrays through the result queue instead
+    return None, arrays, stats
+
+
+class SharedBatchRing:
+    def __init__(self, num_slots, slot_bytes):
+        """
+        ring of shared memory slots, must be created before forking workers
+        :param num_slots: number of batches that can be in flight
+        :param slot_bytes: capacity of one slot
+        """
+        self._slot_bytes = slot_bytes
+        self._slots = [mmap.mmap(-1, slot_bytes) for _ in range(num_slots)]
+        self._free = collections.deque(range(num_slots))
+
+    @property
+    def num_free(self):
+        return len(self._free)
+
+    def acquire(self):
+        """take a free slot, the caller owns it until release"""
+        return self._free.popleft()
+
+    def release(self, slot):
+        """return slot to the ring, no view of it may be used afterwards"""
+        assert slot not in self._free, 'slot {} released twice'.format(slot)
+        self._free.append(slot)
+
+    def write(self, slot, arrays):
+        """copy arrays into slot as float32, return layout [(shape, offset)] or None if they do not fit"""
+        layout = []
+        offset = 0
+        for arr in arrays:
+            nbytes = arr.size * 4
+            if offset + nbytes > self._slot_bytes:
+                return None
+            view = np.frombuffer(self._slots[slot], dtype=np.float32, count=arr.size, offset=offset)
+            np.copyto(view.reshape(arr.shape), arr, casting='unsafe')
+            layout.append((arr.shape, offset))
+            offset += (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+        return layout
+
+    def read(self, slot, layout):
+        """zero-copy float32 views of arrays written into slot"""
+        return [np.frombuffer(self._slots[slot], dtype=np.float32, count=int(np.prod(shape)), offset=offset)
+                .reshape(shape) for shape, offset in layout]
+
+
+class Prefetcher:
+    def __init__(self, loader, num_workers, prefetch, slot_bytes):
+        """
+        load batches with loader.load_batch(indices, rng) in forked workers
+        :param loader: object providing load_batch, decoder and caches, shared with workers by fork
+        :param num_workers: number of worker processes
+        :param prefetch: max number of batches in flight
+        :param slot_bytes: shared memory reserved for one batch
+        """
+        self._decoder = loader.decoder
+        self._caches = loader.caches
+        self._ring = SharedBatchRing(prefetch, slot_bytes)
+        self._pending = collections.deque()
+        self._pool = multiprocessing.get_context('fork').Pool(
+            num_workers, initializer=_init_worker, initargs=(loader, self._ring))
+        self._warned = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def can_submit(self):
+        return self._ring.num_free > 0
+
+    def submit(self, indices, seed):
+        slot = self._ring.acquire()
+        self._pending.append((slot, self._pool.apply_async(_worker_load_batch, (indices, seed, slot))))
+
+    def get(self):
+        """
+        wait for the oldest batch
+        :return: slot, list of arrays; arrays may be views of slot and are only valid until release(slot)
+        """
+        slot, result = self._pending.popleft()
+        try:
+            layout, arrays, ((calls, seconds), cache_stats) = result.get()
+        except Exception:
+            self._ring.release(slot)
+            raise
+        self._decoder.calls += calls
+        self._decoder.seconds += seconds
+        for cache, (hits, misses) in zip(self._caches, cache_stats):
+            cache.hits += hits
+            cache.misses += misses
+        if layout is None:
+            if not self._warned:
+                logger.warning('batch exceeds shared memory slot, falling back to pickled transport')
+                self._warned = True
+            return slot, arrays
+        return slot, self._ring.read(slot, layout)
+
+    def release(self, slot):
+        self._ring.release(slot)
+
+    def clear(self):
+        """drop batches in flight, slots are recycled only after their workers are done writing"""
+        while self._pending:
+            slot, result = self._pending.popleft()
+            result.wait()
+            self._ring.release(slot)
+
+    def close(self):
+        self._pool.terminate()
+        self._pending.clear()
@@ -0,0 +1,61 @@
+import numpy as np
+
+from symdata.image import get_scale
+
+
+class AspectRatioSampler:
+    def __init__(self, roidb, batch_size, short, max_size, ratio_bins=(1.0,)):
+        """
+        order roidb so that every batch holds images of similar aspect ratio and little padding
+        :param roidb: roi_rec need "height" and "width"
+        :param batch_size: images per batch
+        :param short: resize short side as in loader
+        :param max_size: resize max size as in loader
+        :param ratio_bins: width / height bucket boundaries, default splits portrait and landscape
+        """
+        self._batch_size = batch_size
+        heights = np.array([roi_rec['height'] for roi_rec in roidb], dtype=np.float64)
+        widths = np.array([roi_rec['width'] for roi_rec in roidb], dtype=np.float64)
+        self._buckets = np.digitize(widths / heights, ratio_bins)
+
+        # network input size after resize, for padding statistics
+        scales = np.array([get_scale(h, w, short, max_size) for h, w in zip(heights, widths)])
+        self._heights = np.round(heights * scales)
+        self._widths = np.round(widths * scales)
+
+    def sample(self, rng=None):
+        """
+        :param rng: random state to shuffle with, None keeps roidb order
+        :return: permutation of roidb indexes, consecutive batch_size chunks are batches
+        """
+        batches = []
+        remainder = []
+        for bucket in np.unique(self._buckets):
+            inds = np.where(self._buckets == bucket)[0]
+            if rng is not None:
+                inds = rng.permutation(inds)
+            num_full = len(inds) // self._batch_size * self._batch_size
+            batches.extend(inds[:num_full].reshape((-1, self._batch_size)))
+            remainder.append(inds[num_full:])
+
+        # leftovers of all buckets form mixed batches, so that no image is dropped
+        remainder = np.concatenate(remainder)
+        if rng is not None:
+            remainder = rng.permutation(remainder)
+        num_full = len(remainder) // self._batch_size * self._batch_size
+        batches.extend(remainder[:num_full].reshape((-1, self._batch_size)))
+
+        # only full batches are shuffled, the partial one goes last so that it does not shift the others
+        order = np.arange(len(batches))
+        if rng is not None:
+            order = rng.permutation(order)
+        return np.concatenate([batches[i] for i in order] + [remainder[num_full:]]).astype(np.int64)
+
+    def padding_waste(self, index):
+        """fraction of batch input pixels that are padding when batching roidb in index order"""
+        num_full = len(index) // self._batch_size * self._batch_size
+        index = np.asarray(index[:num_full]).reshape((-1, self._batch_size))
+        heights = self._heights[index]
+        widths = self._widths[index]
+        padded = heights.max(axis=1) * widths.max(axis=1) * self._batch_size
+        return 1.0 - (heights * widths).sum() / max(padded.sum(), 1.0)
@@ -1,10 +1,12 @@
 import os
 import json
+import datetime
 import numpy as np
 from builtins import range
 
 from symnet.logger import logger
-from .imdb import IMDB
+from .imdb import IMDB, eval_map
+from .roidb import Roidb
 
 # coco api
 from pycocotools.coco import COCO
@@ -42,122 +44,157 @@ class coco(IMDB):
         # example detections_val2017_results.json
         self._result_file = os.path.join(data_path, 'detections_{}_results.json'.format(image_set))
         # get roidb
-        self._roidb = self._get_cached('roidb', self._load_gt_roidb)
+        self._roidb = self._get_cached_roidb(self._load_gt_roidb)
         logger.info('%s num_images %d' % (self.name, self.num_images))
 
     def _load_gt_roidb(self):
-        _coco = COCO(self._anno_file)
-        # deal with class names
-        cats = [cat['name'] for cat in _coco.loadCats(_coco.getCatIds())]
-        class_to_coco_ind = dict(zip(cats, _coco.getCatIds()))
-        class_to_ind = dict(zip(self.classes, range(self.num_classes)))
-        coco_ind_to_class_ind = dict([(class_to_coco_ind[cls], class_to_ind[cls])
-                                     for cls in self.classes[1:]])
-
-        image_ids = _coco.getImgIds()
-        gt_roidb = [self._load_annotation(_coco, coco_ind_to_class_ind, index) for index in image_ids]
-        return gt_roidb
-
-    def _load_annotation(self, _coco, coco_ind_to_class_ind, index):
         """
+        build the roidb from the annotation json in one pass, without per-image coco api calls
         coco ann: [u'segmentation', u'area', u'iscrowd', u'image_id', u'bbox', u'category_id', u'id']
         iscrowd:
             crowd instances are handled by marking their overlaps with all categories to -1
             and later excluded in training
         bbox:
             [x1, y1, w, h]
-        :param index: coco image id
-        :return: roidb entry
+        :return: Roidb in image order of the json, boxes of every image in annotation order
         """
-        im_ann = _coco.loadImgs(index)[0]
-        filename = self._image_file_tmpl.format(im_ann['file_name'])
-        width = im_ann['width']
-        height = im_ann['height']
+        with open(self._anno_file, 'r') as f:
+            dataset = json.load(f)
 
-        annIds = _coco.getAnnIds(imgIds=index, iscrowd=None)
-        objs = _coco.loadAnns(annIds)
+        # deal with class names
+        class_to_ind = dict(zip(self.classes, range(self.num_classes)))
+        cats = dataset['categories']
+        coco_ind_to_class_ind = np.full((max([cat['id'] for cat in cats]) + 1,), -1, dtype=np.int32)
+        for cat in cats:
+            coco_ind_to_class_ind[cat['id']] = class_to_ind[cat['name']]
+
+        images = dataset['images']
+        if not images:
+            return Roidb.from_records([])
+        image_ids = np.array([im['id'] for im in images], dtype=np.int64)
+        widths = np.array([im['width'] for im in images], dtype=np.int32)
+        heights = np.array([im['height'] for im in images], dtype=np.int32)
+        filenames = np.array([self._image_file_tmpl.format(im['file_name']).encode('utf-8') for im in images],
+                             dtype=np.bytes_)
+
+        # image of every annotation
+        anns = dataset.get('annotations', [])
+        ann_image_ids = np.array([ann['image_id'] for ann in anns], dtype=np.int64)
+        sorter = np.argsort(image_ids, kind='mergesort')
+        pos = sorter[np.minimum(np.searchsorted(image_ids, ann_image_ids, sorter=sorter), len(sorter) - 1)]
+        known = image_ids[pos] == ann_image_ids
 
         # sanitize bboxes
-        valid_objs = []
-        for obj in objs:
-            x, y, w, h = obj['bbox']
-            x1 = np.max((0, x))
-            y1 = np.max((0, y))
-            x2 = np.min((width - 1, x1 + np.max((0, w - 1))))
-            y2 = np.min((height - 1, y1 + np.max((0, h - 1))))
-            if obj['area'] > 0 and x2 >= x1 and y2 >= y1:
-                obj['clean_bbox'] = [x1, y1, x2, y2]
-                valid_objs.append(obj)
-        objs = valid_objs
-        num_objs = len(objs)
-
-        boxes = np.zeros((num_objs, 4), dtype=np.uint16)
-        gt_classes = np.zeros((num_objs,), dtype=np.int32)
-        for ix, obj in enumerate(objs):
-            cls = coco_ind_to_class_ind[obj['category_id']]
-            boxes[ix, :] = obj['clean_bbox']
-            gt_classes[ix] = cls
-
-        roi_rec = {'index': index,
-                   'image': filename,
-                   'height': height,
-                   'width': width,
-                   'boxes': boxes,
-                   'gt_classes': gt_classes,
-                   'flipped': False}
-        return roi_rec
-
-    def _evaluate_detections(self, detections, **kargs):
+        bbox = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape((-1, 4))
+        area = np.array([ann['area'] for ann in anns], dtype=np.float64)
+        x1 = np.maximum(0, bbox[:, 0])
+        y1 = np.maximum(0, bbox[:, 1])
+        x2 = np.minimum(widths[pos] - 1, x1 + np.maximum(0, bbox[:, 2] - 1))
+        y2 = np.minimum(heights[pos] - 1, y1 + np.maximum(0, bbox[:, 3] - 1))
+        valid = np.flatnonzero(known & (area > 0) & (x2 >= x1) & (y2 >= y1))
+
+        # group valid annotations by image, keeping annotation order
+        valid = valid[np.argsort(pos[valid], kind='mergesort')]
+        box_offsets = np.zeros((len(images) + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(pos[valid], minlength=len(images)), out=box_offsets[1:])
+        boxes = np.stack((x1[valid], y1[valid], x2[valid], y2[valid]), axis=1).astype(np.uint16)
+        gt_classes = coco_ind_to_class_ind[np.array([anns[i]['category_id'] for i in valid], dtype=np.int64)]
+        assert (gt_classes > 0).all(), 'unknown category_id'
+
+        return Roidb({'index': image_ids,
+                      'image': filenames,
+                      'height': heights,
+                      'width': widths,
+                      'flipped': np.zeros((len(images),), dtype=bool),
+                      'box_offsets': box_offsets,
+                      'boxes': boxes.reshape((-1, 4)),
+                      'gt_classes': gt_classes.astype(np.int32)})
+
+    def _evaluate_detections(self, detections, write_results=True, eval_workers=1, **kargs):
+        """
+        :param write_results: stream results to the json file and evaluate it, otherwise hand the results
+                              to the coco api as an array without the file round trip
+        :param eval_workers: processes evaluating categories in parallel
+        """
         _coco = COCO(self._anno_file)
-        self._write_coco_results(_coco, detections)
-        self._do_python_eval(_coco)
+        if write_results:
+            self._write_coco_results(_coco, detections)
+            self._do_python_eval(_coco, eval_workers=eval_workers)
+        else:
+            self._do_python_eval(_coco, self._coco_results(_coco, detections), eval_workers=eval_workers)
 
-    def _write_coco_results(self, _coco, detections):
-        """ example results
+    def _coco_results(self, _coco, detections):
+        """
+        detections of all images and categories as rows of [image_id, x, y, w, h, score, category_id],
+        the array format of coco loadRes
+        """
+        cats = [cat['name'] for cat in _coco.loadCats(_coco.getCatIds())]
+        class_to_coco_ind = dict(zip(cats, _coco.getCatIds()))
+        cat_ids = np.zeros((self.num_classes,), dtype=np.int64)
+        for cls_ind, cls in enumerate(self.classes):
+            if cls != '__background__':
+                cat_ids[cls_ind] = class_to_coco_ind[cls]
+        columns = detections.columns
+        boxes = columns['boxes'].astype(np.float64)
+        results = np.empty((len(detections), 7), dtype=np.float64)
+        results[:, 0] = self.roidb.columns['index'][columns['image']]
+        results[:, 1:3] = boxes[:, 0:2]
+        results[:, 3:5] = boxes[:, 2:4] - boxes[:, 0:2] + 1
+        results[:, 5] = columns['score']
+        results[:, 6] = cat_ids[columns['cls']]
+        return results
+
+    def _write_coco_results(self, _coco, detections, chunk_size=100000):
+        """ example results, written chunk by chunk without indentation
         [{"image_id": 42,
           "category_id": 18,
           "bbox": [258.15,41.29,348.26,243.78],
           "score": 0.236}, ...]
         """
-        cats = [cat['name'] for cat in _coco.loadCats(_coco.getCatIds())]
-        class_to_coco_ind = dict(zip(cats, _coco.getCatIds()))
-        results = []
-        for cls_ind, cls in enumerate(self.classes):
-            if cls == '__background__':
-                continue
-            logger.info('collecting %s results (%d/%d)' % (cls, cls_ind, self.num_classes - 1))
-            coco_cat_id = class_to_coco_ind[cls]
-            results.extend(self._coco_results_one_category(detections[cls_ind], coco_cat_id))
         logger.info('writing results json to %s' % self._result_file)
+        result_tmpl = '{"image_id":%d,"category_id":%d,"bbox":[%r,%r,%r,%r],"score":%r}'
+        results = self._coco_results(_coco, detections)
         with open(self._result_file, 'w') as f:
-            json.dump(results, f, sort_keys=True, indent=4)
-
-    def _coco_results_one_category(self, boxes, cat_id):
-        results = []
-        for im_ind, roi_rec in enumerate(self.roidb):
-            index = roi_rec['index']
-            dets = boxes[im_ind].astype(np.float)
-            if len(dets) == 0:
-                continue
-            scores = dets[:, -1]
-            xs = dets[:, 0]
-            ys = dets[:, 1]
-            ws = dets[:, 2] - xs + 1
-            hs = dets[:, 3] - ys + 1
-            result = [{'image_id': index,
-                       'category_id': cat_id,
-                       'bbox': [xs[k], ys[k], ws[k], hs[k]],
-                       'score': scores[k]} for k in range(dets.shape[0])]
-            results.extend(result)
-        return results
-
-    def _do_python_eval(self, _coco):
-        coco_dt = _coco.loadRes(self._result_file)
+            f.write('[')
+            for start in range(0, len(results), chunk_size):
+                if start:
+                    f.write(',\n')
+                chunk = results[start:start + chunk_size].tolist()
+                f.write(',\n'.join([result_tmpl % (image_id, cat_id, x, y, w, h, score)
+                                     for image_id, x, y, w, h, score, cat_id in chunk]))
+            f.write(']')
+
+    def _do_python_eval(self, _coco, results=None, eval_workers=1):
+        """evaluate results array, or the results json file if None"""
+        coco_dt = _coco.loadRes(self._result_file if results is None else results)
         coco_eval = COCOeval(_coco, coco_dt)
         coco_eval.params.useSegm = False
+        if eval_workers > 1:
+            # categories are evaluated independently, contiguous chunks keep their order in the results
+            cat_ids = coco_eval.params.catIds
+            chunks = [chunk.tolist() for chunk in np.array_split(cat_ids, min(4 * eval_workers, len(cat_ids)))]
+            evals = eval_map(self._eval_categories, coco_eval, chunks, eval_workers)
+            coco_eval.params.catIds = cat_ids
+            precision, recall, scores = [np.concatenate(arrays, axis=axis)
+                                         for arrays, axis in zip(zip(*evals), (2, 1, 2))]
+            coco_eval.eval = {'params': coco_eval.params,
+                              'counts': list(precision.shape),
+                              'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                              'precision': precision,
+                              'recall': recall,
+                              'scores': scores}
+        else:
+            coco_eval.evaluate()
+            coco_eval.accumulate()
+        self._print_detection_metrics(coco_eval)
+
+    @staticmethod
+    def _eval_categories(coco_eval, cat_ids):
+        """precision, recall, scores of COCOeval restricted to cat_ids"""
+        coco_eval.params.catIds = cat_ids
         coco_eval.evaluate()
         coco_eval.accumulate()
-        self._print_detection_metrics(coco_eval)
+        return coco_eval.eval['precision'], coco_eval.eval['recall'], coco_eval.eval['scores']
 
     def _print_detection_metrics(self, coco_eval):
         IoU_lo_thresh = 0.5
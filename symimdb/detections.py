@@ -0,0 +1,91 @@
+"""
+Columnar detections, a replacement of the all_boxes[cls][image] nested lists.
+
+Detections of all images are flat arrays sorted by image then class, image_offsets slices the
+detections of every image. Every column is saved as a .npy file in a cache folder and memory-mapped
+when loaded, so cached detections are evaluated again without running the network.
+"""
+
+import numpy as np
+
+from .roidb import save_columns, load_columns
+
+# per-detection columns, boxes are (x1, y1, x2, y2) in original image coordinates
+FIELDS = ('image', 'cls', 'score', 'boxes')
+
+
+class Detections(object):
+    def __init__(self, columns):
+        """
+        :param columns: dict of FIELDS sorted by image then class and image_offsets of length num_images + 1
+        """
+        self._columns = columns
+        self._cls_order = None
+
+    @classmethod
+    def from_arrays(cls, num_images, image, cls_inds, score, boxes):
+        """
+        sort detections given in any order by image then class, keeping their order within a class
+        score and boxes keep their dtype, float64 as returned by im_detect
+        """
+        order = np.lexsort((cls_inds, image))
+        image_offsets = np.zeros((num_images + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(image, minlength=num_images), out=image_offsets[1:])
+        return cls({'image': image[order].astype(np.int64),
+                    'cls': cls_inds[order].astype(np.int32),
+                    'score': score[order],
+                    'boxes': boxes[order].reshape((-1, 4)),
+                    'image_offsets': image_offsets})
+
+    @classmethod
+    def from_images(cls, dets):
+        """
+        :param dets: dets[image] = N x 6 array of (cls, score, x1, y1, x2, y2) as returned by im_detect
+        """
+        num_dets = [len(det) for det in dets]
+        det = np.concatenate(list(dets) + [np.zeros((0, 6), dtype=np.float64)])
+        return cls.from_arrays(len(dets), np.repeat(np.arange(len(dets)), num_dets), det[:, 0].astype(np.int32),
+                               det[:, 1], det[:, 2:6])
+
+    @classmethod
+    def from_all_boxes(cls, all_boxes):
+        """
+        :param all_boxes: all_boxes[cls][image] = N x 5 array of (x1, y1, x2, y2, score)
+        """
+        parts = [(im_ind, cls_ind, det) for cls_ind in range(1, len(all_boxes))
+                 for im_ind, det in enumerate(all_boxes[cls_ind]) if len(det)]
+        num_dets = [len(det) for _, _, det in parts]
+        image = np.repeat([im_ind for im_ind, _, _ in parts], num_dets).astype(np.int64)
+        cls_inds = np.repeat([cls_ind for _, cls_ind, _ in parts], num_dets).astype(np.int32)
+        det = np.concatenate([det for _, _, det in parts] + [np.zeros((0, 5), dtype=np.float64)])
+        return cls.from_arrays(len(all_boxes[0]), image, cls_inds, det[:, 4], det[:, :4])
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """load columns saved by save, memory-mapped by default"""
+        return cls(load_columns(path, mmap_mode))
+
+    def save(self, path):
+        """save every column as path/<column>.npy, the folder appears or is replaced only when complete"""
+        save_columns(path, self._columns)
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def num_images(self):
+        return len(self._columns['image_offsets']) - 1
+
+    def __len__(self):
+        return len(self._columns['image'])
+
+    def class_dets(self, cls_ind):
+        """image, score and boxes of the detections of class cls_ind, in image order"""
+        if self._cls_order is None:
+            cls_order = np.argsort(self._columns['cls'], kind='mergesort')
+            self._cls_order = cls_order, self._columns['cls'][cls_order]
+        cls_order, sorted_cls = self._cls_order
+        inds = cls_order[np.searchsorted(sorted_cls, cls_ind, side='left'):
+                         np.searchsorted(sorted_cls, cls_ind, side='right')]
+        return self._columns['image'][inds], self._columns['score'][inds], self._columns['boxes'][inds]
@@ -8,16 +8,49 @@ property: name, classes, num_classes, roidb, num_images
 append_flipped_images
 evaluate_detections
 
-roidb is a list of roi_rec
+roidb is a Roidb, a columnar store indexed like a list of roi_rec
 roi_rec is a dict of keys ["index", "image", "height", "width", "boxes", "gt_classes", "flipped"]
+boxes are in original image coordinates, flipped images are flipped with their boxes when loading
+detections is a Detections, flat columns of detections of all images
 """
 
 from symnet.logger import logger
+from .roidb import Roidb
+from .detections import Detections
 import os
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import multiprocessing
+import numpy as np
+
+# state of the running eval_map, inherited by forked workers instead of pickled to them
+_eval_state = None
+
+
+def _eval_worker(args):
+    fn, item = args
+    return fn(_eval_state, item)
+
+
+def eval_map(fn, state, items, num_workers):
+    """
+    [fn(state, item) for item in items], spread over num_workers forked processes
+    state (roidb, detections, annotations) is shared copy-on-write, only items and results are pickled
+    :param fn: module level function or static method
+    :return: results in order of items
+    """
+    global _eval_state
+    num_workers = min(num_workers, len(items))
+    if num_workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return [fn(state, item) for item in items]
+    _eval_state = state
+    try:
+        pool = multiprocessing.get_context('fork').Pool(num_workers)
+        try:
+            return pool.map(_eval_worker, [(fn, item) for item in items], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _eval_state = None
 
 
 class IMDB(object):
@@ -33,7 +66,7 @@ class IMDB(object):
 
         # abstract attributes
         self._classes = []
-        self._roidb = []
+        self._roidb = Roidb.from_records([])
 
         # create cache
         cache_folder = os.path.join(self._root_path, 'cache')
@@ -59,51 +92,55 @@ class IMDB(object):
     def filter_roidb(self):
         """Remove images without usable rois"""
         num_roidb = len(self._roidb)
-        self._roidb = [roi_rec for roi_rec in self._roidb if len(roi_rec['gt_classes'])]
+        keep = np.flatnonzero(self._roidb.num_boxes)
+        # take copies the columns into memory, a roidb without empty images stays memory-mapped
+        if len(keep) < num_roidb:
+            self._roidb = self._roidb.take(keep)
         num_after = len(self._roidb)
         logger.info('filter roidb: {} -> {}'.format(num_roidb, num_after))
 
     def append_flipped_images(self):
-        """Only flip boxes coordinates, images will be flipped when loading into network"""
+        """Append a flipped view of every image, images and boxes will be flipped when loading into network"""
         logger.info('%s append flipped images to roidb' % self._name)
-        roidb_flipped = []
-        for roi_rec in self._roidb:
-            boxes = roi_rec['boxes'].copy()
-            oldx1 = boxes[:, 0].copy()
-            oldx2 = boxes[:, 2].copy()
-            boxes[:, 0] = roi_rec['width'] - oldx2 - 1
-            boxes[:, 2] = roi_rec['width'] - oldx1 - 1
-            assert (boxes[:, 2] >= boxes[:, 0]).all()
-            roi_rec_flipped = roi_rec.copy()
-            roi_rec_flipped['boxes'] = boxes
-            roi_rec_flipped['flipped'] = True
-            roidb_flipped.append(roi_rec_flipped)
-        self._roidb.extend(roidb_flipped)
+        self._roidb = self._roidb.append_flipped()
 
     def evaluate_detections(self, detections, **kwargs):
-        cache_path = os.path.join(self._root_path, 'cache', '{}_{}.pkl'.format(self._name, 'detections'))
+        """:param detections: Detections, or all_boxes[cls][image] = N x 5 array of (x1, y1, x2, y2, score)"""
+        if not isinstance(detections, Detections):
+            detections = Detections.from_all_boxes(detections)
+        cache_path = os.path.join(self._root_path, 'cache', '{}_{}'.format(self._name, 'detections'))
         logger.info('saving cache {}'.format(cache_path))
-        with open(cache_path, 'wb') as fid:
-            pickle.dump(detections, fid, pickle.HIGHEST_PROTOCOL)
+        detections.save(cache_path)
         self._evaluate_detections(detections, **kwargs)
 
-    def _get_cached(self, cache_item, fn):
-        cache_path = os.path.join(self._root_path, 'cache', '{}_{}.pkl'.format(self._name, cache_item))
-        if os.path.exists(cache_path):
-            logger.info('loading cache {}'.format(cache_path))
-            with open(cache_path, 'rb') as fid:
-                cached = pickle.load(fid)
-            return cached
-        else:
+    def evaluate_cached_detections(self, **kwargs):
+        """evaluate the detections cached by the last evaluate_detections, memory-mapped"""
+        cache_path = os.path.join(self._root_path, 'cache', '{}_{}'.format(self._name, 'detections'))
+        logger.info('loading cache {}'.format(cache_path))
+        detections = Detections.load(cache_path)
+        assert detections.num_images == self.num_images, 'cached detections are of {} images'.format(
+            detections.num_images)
+        self._evaluate_detections(detections, **kwargs)
+
+    def _get_cached_roidb(self, fn):
+        """roidb memory-mapped from the columnar cache folder, fn returns a Roidb or a list of roi_rec to build it"""
+        cache_path = os.path.join(self._root_path, 'cache', '{}_{}'.format(self._name, 'roidb'))
+        if not os.path.exists(cache_path):
             logger.info('computing cache {}'.format(cache_path))
-            cached = fn()
+            roidb = fn()
+            if not isinstance(roidb, Roidb):
+                roidb = Roidb.from_records(roidb)
             logger.info('saving cache {}'.format(cache_path))
-            with open(cache_path, 'wb') as fid:
-                pickle.dump(cached, fid, pickle.HIGHEST_PROTOCOL)
-            return cached
+            roidb.save(cache_path)
+        logger.info('loading cache {}'.format(cache_path))
+        return Roidb.load(cache_path)
 
     def _load_gt_roidb(self):
         raise NotImplementedError
 
     def _evaluate_detections(self, detections, **kwargs):
         raise NotImplementedError
+
+    def detection_accumulator(self, **kwargs):
+        """accumulator evaluating detections image by image as they are produced"""
+        raise NotImplementedError('{} does not support streaming evaluation'.format(self._name))
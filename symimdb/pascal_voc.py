@@ -1,8 +1,10 @@
 import os
+import multiprocessing
 import numpy as np
 
 from symnet.logger import logger
-from .imdb import IMDB
+from .imdb import IMDB, eval_map
+from .roidb import Roidb
 
 
 class PascalVOC(IMDB):
@@ -13,12 +15,13 @@ class PascalVOC(IMDB):
                'motorbike', 'person', 'pottedplant',
                'sheep', 'sofa', 'train', 'tvmonitor']
 
-    def __init__(self, image_set, root_path, devkit_path):
+    def __init__(self, image_set, root_path, devkit_path, num_workers=None):
         """
         fill basic information to initialize imdb
         :param image_set: 2007_trainval, 2007_test, etc
         :param root_path: 'data', will write 'cache'
         :param devkit_path: 'data/VOCdevkit', load data and write results
+        :param num_workers: processes parsing annotations, None uses all cpus
         """
         super(PascalVOC, self).__init__('voc_' + image_set, root_path)
 
@@ -26,6 +29,7 @@ class PascalVOC(IMDB):
         self._config = {'comp_id': 'comp4',
                         'use_diff': False,
                         'min_size': 2}
+        self._num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count()
         self._class_to_ind = dict(zip(self.classes, range(self.num_classes)))
         self._image_index_file = os.path.join(devkit_path, 'VOC' + year, 'ImageSets', 'Main', image_set + '.txt')
         self._image_file_tmpl = os.path.join(devkit_path, 'VOC' + year, 'JPEGImages', '{}.jpg')
@@ -38,12 +42,69 @@ class PascalVOC(IMDB):
         self._result_file_tmpl = os.path.join(result_folder, 'comp4_det_' + image_set + '_{}.txt')
 
         # get roidb
-        self._roidb = self._get_cached('roidb', self._load_gt_roidb)
+        self._roidb = self._get_incremental_roidb()
         logger.info('%s num_images %d' % (self.name, self.num_images))
 
-    def _load_gt_roidb(self):
+    def _get_incremental_roidb(self):
+        """
+        roidb memory-mapped from the columnar cache folder, only annotations added or modified
+        since the cache was saved are parsed, judged by their mtime and size
+        """
+        cache_path = os.path.join(self._root_path, 'cache', '{}_{}'.format(self._name, 'roidb'))
         image_index = self._load_image_index()
-        gt_roidb = [self._load_annotation(index) for index in image_index]
+        stats = [os.stat(self._image_anno_tmpl.format(index)) for index in image_index]
+        mtimes = np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64)
+        sizes = np.array([stat.st_size for stat in stats], dtype=np.int64)
+
+        # rows of cached roidb with unchanged annotation, -1 to parse
+        cached = Roidb.load(cache_path) if os.path.exists(cache_path) else None
+        extra = Roidb.load_extra(cache_path) if cached is not None else dict()
+        rows = np.full((len(image_index),), -1, dtype=np.int64)
+        if 'anno_mtime' in extra and 'anno_size' in extra:
+            cached_rows = dict((index, row) for row, index in enumerate(cached.columns['index']))
+            for i, index in enumerate(image_index):
+                row = cached_rows.get(index.encode('utf-8'), -1)
+                if row >= 0 and extra['anno_mtime'][row] == mtimes[i] and extra['anno_size'][row] == sizes[i]:
+                    rows[i] = row
+            if np.array_equal(rows, np.arange(len(cached))):
+                logger.info('loading cache {}'.format(cache_path))
+                return cached
+
+        reuse = np.flatnonzero(rows >= 0)
+        parse = np.flatnonzero(rows < 0)
+        logger.info('computing cache {}, {} annotations cached, {} to parse'.format(
+            cache_path, len(reuse), len(parse)))
+        parts = []
+        if len(reuse):
+            parts.append(cached.take(rows[reuse]))
+        if len(parse):
+            parts.append(Roidb.from_records(self._load_gt_roidb([image_index[i] for i in parse])))
+        roidb = Roidb.concat(parts) if parts else Roidb.from_records([])
+
+        # back to image_index order
+        order = np.empty((len(image_index),), dtype=np.int64)
+        order[np.concatenate([reuse, parse])] = np.arange(len(image_index))
+        roidb = roidb.take(order)
+        logger.info('saving cache {}'.format(cache_path))
+        roidb.save(cache_path, extra={'anno_mtime': mtimes, 'anno_size': sizes})
+        return Roidb.load(cache_path)
+
+    def _load_gt_roidb(self, image_index=None):
+        """roi_rec of image_index, all images by default, annotations are parsed by a process pool"""
+        if image_index is None:
+            image_index = self._load_image_index()
+        filenames = [self._image_anno_tmpl.format(index) for index in image_index]
+        num_workers = min(self._num_workers, len(filenames))
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                annos = pool.map(self._parse_voc_anno, filenames, chunksize=max(1, len(filenames) // (4 * num_workers)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            annos = [self._parse_voc_anno(filename) for filename in filenames]
+        gt_roidb = [self._load_annotation(index, anno) for index, anno in zip(image_index, annos)]
         return gt_roidb
 
     def _load_image_index(self):
@@ -51,9 +112,11 @@ class PascalVOC(IMDB):
             image_set_index = [x.strip() for x in f.readlines()]
         return image_set_index
 
-    def _load_annotation(self, index):
-        # store original annotation as orig_objs
-        height, width, orig_objs = self._parse_voc_anno(self._image_anno_tmpl.format(index))
+    def _load_annotation(self, index, anno=None):
+        # store original annotation as orig_objs, anno is the result of _parse_voc_anno if parsed already
+        if anno is None:
+            anno = self._parse_voc_anno(self._image_anno_tmpl.format(index))
+        height, width, orig_objs = anno
 
         # filter difficult objects
         if not self._config['use_diff']:
@@ -105,114 +168,162 @@ class PascalVOC(IMDB):
             objects.append(obj_dict)
         return height, width, objects
 
-    def _evaluate_detections(self, detections, use_07_metric=True, **kargs):
+    def _evaluate_detections(self, detections, use_07_metric=True, eval_workers=1, **kargs):
         self._write_pascal_results(detections)
-        self._do_python_eval(detections, use_07_metric)
+        self._do_python_eval(detections, use_07_metric, eval_workers)
 
-    def _write_pascal_results(self, all_boxes):
+    def _write_pascal_results(self, detections):
+        indexes = [roi_rec['index'] for roi_rec in self.roidb]
         for cls_ind, cls in enumerate(self.classes):
             if cls == '__background__':
                 continue
             logger.info('Writing %s VOC results file' % cls)
             filename = self._result_file_tmpl.format(cls)
+            image_ids, confidence, bbox = detections.class_dets(cls_ind)
+            # the VOCdevkit expects 1-based indices
+            bbox = bbox.astype(np.float64) + 1
             with open(filename, 'wt') as f:
-                for im_ind, roi_rec in enumerate(self.roidb):
-                    index = roi_rec['index']
-                    dets = all_boxes[cls_ind][im_ind]
-                    if len(dets) == 0:
-                        continue
-                    # the VOCdevkit expects 1-based indices
-                    for k in range(dets.shape[0]):
-                        f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
-                                format(index, dets[k, -1],
-                                       dets[k, 0] + 1, dets[k, 1] + 1, dets[k, 2] + 1, dets[k, 3] + 1))
-
-    def _do_python_eval(self, all_boxes, use_07_metric):
+                for im_ind, score, (x1, y1, x2, y2) in zip(image_ids.tolist(), confidence.tolist(), bbox.tolist()):
+                    f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.format(indexes[im_ind], score, x1, y1, x2, y2))
+
+    def _do_python_eval(self, detections, use_07_metric, eval_workers=1):
+        gt_objects = self._gt_objects()
+        cls_inds = [cls_ind for cls_ind, cls in enumerate(self.classes) if cls != '__background__']
+        results = eval_map(self._eval_class, (gt_objects, detections, use_07_metric), cls_inds, eval_workers)
+        self._log_results(cls_inds, results)
+
+    def detection_accumulator(self, use_07_metric=True, **kargs):
+        return VOCAccumulator(self, use_07_metric)
+
+    def _log_results(self, cls_inds, results):
         aps = []
-        for cls_ind, cls in enumerate(self.classes):
-            if cls == '__background__':
-                continue
-            # class_anno is a dict [image_index, [bbox, difficult, det]]
-            class_anno = {}
-            npos = 0
-            for roi_rec in self.roidb:
-                index = roi_rec['index']
-                objects = [obj for obj in roi_rec['objs'] if obj['name'] == cls]
-                bbox = np.array([x['bbox'] for x in objects])
-                difficult = np.array([x['difficult'] for x in objects]).astype(np.bool)
-                det = [False] * len(objects)  # stand for detected
-                npos = npos + sum(~difficult)
-                class_anno[index] = {'bbox': bbox,
-                                     'difficult': difficult,
-                                     'det': det}
-
-            # bbox is 2d array of all detections, corresponding to each image_id
-            image_ids = []
-            bbox = []
-            confidence = []
-            for im_ind, dets in enumerate(all_boxes[cls_ind]):
-                for k in range(dets.shape[0]):
-                    image_ids.append(self.roidb[im_ind]['index'])
-                    bbox.append([dets[k, 0] + 1, dets[k, 1] + 1, dets[k, 2] + 1, dets[k, 3] + 1])
-                    confidence.append(dets[k, -1])
-            bbox = np.array(bbox)
-            confidence = np.array(confidence)
-
-            rec, prec, ap = self.voc_eval(class_anno, npos, image_ids, bbox, confidence,
-                                          ovthresh=0.5, use_07_metric=use_07_metric)
+        for cls_ind, (rec, prec, ap) in zip(cls_inds, results):
             aps.append(ap)
-
-            logger.info('AP for {} = {:.4f}'.format(cls, ap))
+            logger.info('AP for {} = {:.4f}'.format(self.classes[cls_ind], ap))
         logger.info('Mean AP = {:.4f}'.format(np.mean(aps)))
 
     @staticmethod
-    def voc_eval(class_anno, npos, image_ids, bbox, confidence, ovthresh=0.5, use_07_metric=False):
-        # sort by confidence
-        if bbox.shape[0] > 0:
-            sorted_inds = np.argsort(-confidence)
-            sorted_scores = np.sort(-confidence)
-            bbox = bbox[sorted_inds, :]
-            image_ids = [image_ids[x] for x in sorted_inds]
+    def _eval_class(state, cls_ind):
+        """rec, prec, ap of class cls_ind, state is (_gt_objects(), detections, use_07_metric)"""
+        (gt_image, gt_class, gt_bbox, gt_difficult), detections, use_07_metric = state
+        cls_mask = gt_class == cls_ind
+        npos = np.count_nonzero(~gt_difficult[cls_mask])
+
+        # detections of all images, bbox is 1-based
+        image_ids, confidence, bbox = detections.class_dets(cls_ind)
+        return PascalVOC.voc_eval(gt_image[cls_mask], gt_bbox[cls_mask], gt_difficult[cls_mask], npos,
+                                  image_ids, bbox + 1, confidence, ovthresh=0.5, use_07_metric=use_07_metric)
+
+    def _gt_objects(self):
+        """image index, class index (-1 for unknown names), bbox and difficult of all gt objects in roidb"""
+        roidb = self.roidb
+        if isinstance(roidb, Roidb) and not roidb.is_flipped_view and 'obj_offsets' in roidb.columns:
+            columns = roidb.columns
+            names, name_inds = np.unique(columns['obj_name'], return_inverse=True)
+            name_to_class = np.array([self._class_to_ind.get(name.decode('utf-8'), -1) for name in names],
+                                     dtype=np.int64)
+            return (np.repeat(np.arange(len(roidb)), np.diff(columns['obj_offsets'])), name_to_class[name_inds],
+                    np.array(columns['obj_bbox'], dtype=np.float64), columns['obj_difficult'] != 0)
+
+        gt_image, gt_class, gt_bbox, gt_difficult = [], [], [], []
+        for im_ind, roi_rec in enumerate(self.roidb):
+            for obj in roi_rec['objs']:
+                gt_image.append(im_ind)
+                gt_class.append(self._class_to_ind.get(obj['name'], -1))
+                gt_bbox.append(obj['bbox'])
+                gt_difficult.append(obj['difficult'])
+        return (np.array(gt_image, dtype=np.int64), np.array(gt_class, dtype=np.int64),
+                np.array(gt_bbox, dtype=np.float64).reshape((-1, 4)), np.array(gt_difficult, dtype=bool))
+
+    @staticmethod
+    def voc_eval(gt_image, gt_bbox, gt_difficult, npos, image_ids, bbox, confidence, ovthresh=0.5, use_07_metric=False):
+        """
+        match detections of one class to gt greedily in order of confidence
+        :param gt_image: [g] image of every gt box
+        :param gt_bbox: [g, 4] gt boxes
+        :param gt_difficult: [g] gt boxes that are neither true nor false positive when matched
+        :param npos: number of gt boxes that are not difficult
+        :param image_ids: [n] image of every detection
+        :param bbox: [n, 4] detection boxes
+        :param confidence: [n] detection scores
+        :return: rec, prec, ap
+        """
+        match = PascalVOC.voc_match(gt_image, gt_bbox, gt_difficult, image_ids, bbox, ovthresh)
+        return PascalVOC.voc_pr(match, confidence, npos, use_07_metric)
 
-        # go down detections and mark true positives and false positives
+    @staticmethod
+    def voc_match(gt_image, gt_bbox, gt_difficult, image_ids, bbox, ovthresh=0.5):
+        """
+        gt box every detection matches, independent of the order of detections
+        :return: [n] index of the gt box with max overlap above ovthresh, -1 for none, -2 for a difficult one
+        """
         nd = len(image_ids)
-        tp = np.zeros(nd)
-        fp = np.zeros(nd)
-        for d in range(nd):
-            r = class_anno[image_ids[d]]
-            bb = bbox[d, :].astype(float)
-            ovmax = -np.inf
-            bbgt = r['bbox'].astype(float)
-
-            if bbgt.size > 0:
-                # compute overlaps
-                # intersection
-                ixmin = np.maximum(bbgt[:, 0], bb[0])
-                iymin = np.maximum(bbgt[:, 1], bb[1])
-                ixmax = np.minimum(bbgt[:, 2], bb[2])
-                iymax = np.minimum(bbgt[:, 3], bb[3])
-                iw = np.maximum(ixmax - ixmin + 1., 0.)
-                ih = np.maximum(iymax - iymin + 1., 0.)
-                inters = iw * ih
-
-                # union
-                uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-                       (bbgt[:, 2] - bbgt[:, 0] + 1.) *
-                       (bbgt[:, 3] - bbgt[:, 1] + 1.) - inters)
-
-                overlaps = inters / uni
-                ovmax = np.max(overlaps)
-                jmax = np.argmax(overlaps)
-
-            if ovmax > ovthresh:
-                if not r['difficult'][jmax]:
-                    if not r['det'][jmax]:
-                        tp[d] = 1.
-                        r['det'][jmax] = 1
-                    else:
-                        fp[d] = 1.
-            else:
-                fp[d] = 1.
+        bbox = bbox.astype(float)
+
+        # pair every detection with the gt boxes of its image, in gt order
+        gt_order = np.argsort(gt_image, kind='mergesort')
+        gt_starts = np.searchsorted(gt_image[gt_order], image_ids, side='left')
+        num_gt = np.searchsorted(gt_image[gt_order], image_ids, side='right') - gt_starts
+        pair_starts = np.cumsum(num_gt) - num_gt
+        pair_det = np.repeat(np.arange(nd), num_gt)
+        pair_gt = gt_order[np.repeat(gt_starts - pair_starts, num_gt) + np.arange(len(pair_det))]
+
+        # compute overlaps
+        bb = bbox[pair_det]
+        bbgt = gt_bbox[pair_gt].astype(float)
+        # intersection
+        ixmin = np.maximum(bbgt[:, 0], bb[:, 0])
+        iymin = np.maximum(bbgt[:, 1], bb[:, 1])
+        ixmax = np.minimum(bbgt[:, 2], bb[:, 2])
+        iymax = np.minimum(bbgt[:, 3], bb[:, 3])
+        iw = np.maximum(ixmax - ixmin + 1., 0.)
+        ih = np.maximum(iymax - iymin + 1., 0.)
+        inters = iw * ih
+
+        # union
+        uni = ((bb[:, 2] - bb[:, 0] + 1.) * (bb[:, 3] - bb[:, 1] + 1.) +
+               (bbgt[:, 2] - bbgt[:, 0] + 1.) *
+               (bbgt[:, 3] - bbgt[:, 1] + 1.) - inters)
+        overlaps = inters / uni
+
+        # max overlap of every detection and its first gt reaching it, -inf without gt
+        has_gt = num_gt > 0
+        ovmax = np.full((nd,), -np.inf)
+        jmax = np.zeros((nd,), dtype=np.int64)
+        if has_gt.any():
+            ovmax[has_gt] = np.maximum.reduceat(overlaps, pair_starts[has_gt])
+        hits = np.flatnonzero(overlaps == ovmax[pair_det])
+        hit_dets, first_hits = np.unique(pair_det[hits], return_index=True)
+        jmax[hit_dets] = pair_gt[hits[first_hits]]
+
+        match = np.where(ovmax > ovthresh, jmax, -1)
+        matched = np.flatnonzero(match >= 0)
+        match[matched[gt_difficult[jmax[matched]]]] = -2
+        return match
+
+    @staticmethod
+    def voc_pr(match, confidence, npos, use_07_metric=False):
+        """
+        rec, prec, ap of detections with their voc_match
+        :param npos: number of gt boxes that are not difficult
+        """
+        # sort by confidence
+        if len(match) > 0:
+            match = match[np.argsort(-confidence)]
+        return PascalVOC.voc_pr_sorted(match, npos, use_07_metric)
+
+    @staticmethod
+    def voc_pr_sorted(match, npos, use_07_metric=False):
+        """rec, prec, ap of voc_match of detections sorted by decreasing confidence"""
+        # go down detections, the first match of a gt box is a true positive and later ones false positives,
+        # matches of difficult gt boxes are neither
+        matched = np.flatnonzero(match >= 0)
+        _, first_matches = np.unique(match[matched], return_index=True)
+        tp = np.zeros(len(match))
+        fp = (match == -1).astype(float)
+        fp[matched] = 1.
+        tp[matched[first_matches]] = 1.
+        fp[matched[first_matches]] = 0.
 
         # compute precision recall
         fp = np.cumsum(fp)
@@ -240,8 +351,7 @@ class PascalVOC(IMDB):
             mpre = np.concatenate(([0.], prec, [0.]))
 
             # compute precision integration ladder
-            for i in range(mpre.size - 1, 0, -1):
-                mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+            mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
             # look for recall value changes
             i = np.where(mrec[1:] != mrec[:-1])[0]
@@ -249,3 +359,105 @@ class PascalVOC(IMDB):
             # sum (\delta recall) * prec
             ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
         return ap
+
+
+class VOCAccumulator(object):
+    def __init__(self, imdb, use_07_metric=True):
+        """
+        evaluate detections of a PascalVOC imdb image by image as they are produced,
+        only the score and the gt box matched by voc_match are kept of every detection
+        :param imdb: PascalVOC
+        :param use_07_metric: 11 point ap as in _evaluate_detections
+        """
+        self._imdb = imdb
+        self._use_07_metric = use_07_metric
+        self.cls_inds = [cls_ind for cls_ind, cls in enumerate(imdb.classes) if cls != '__background__']
+
+        # gt objects grouped by image, their positions are the gt ids of matches
+        gt_image, self._gt_class, self._gt_bbox, self._gt_difficult = imdb._gt_objects()
+        self._gt_order = np.argsort(gt_image, kind='mergesort')
+        self._gt_offsets = np.searchsorted(gt_image[self._gt_order], np.arange(imdb.num_images + 1))
+
+        self._seen = np.zeros((imdb.num_images,), dtype=bool)
+        self._npos = np.zeros((imdb.num_classes,), dtype=np.int64)
+        # image of every chunk of detections, one chunk per update and class
+        self._image_ids = [[] for _ in range(imdb.num_classes)]
+        self._confidence = [[] for _ in range(imdb.num_classes)]
+        self._match = [[] for _ in range(imdb.num_classes)]
+
+        # detections of the running mean_ap sorted by decreasing confidence, with the number of chunks merged
+        self._sorted_confidence = [np.zeros((0,), dtype=np.float64) for _ in range(imdb.num_classes)]
+        self._sorted_match = [np.zeros((0,), dtype=np.int64) for _ in range(imdb.num_classes)]
+        self._num_merged = np.zeros((imdb.num_classes,), dtype=np.int64)
+
+    @property
+    def num_images(self):
+        """number of images seen so far"""
+        return int(np.count_nonzero(self._seen))
+
+    def update(self, im_ind, det):
+        """
+        :param im_ind: index of the image in roidb
+        :param det: N x 6 array of (cls, score, x1, y1, x2, y2) of the image as returned by im_detect
+        """
+        assert not self._seen[im_ind], 'image {} is already evaluated'.format(im_ind)
+        self._seen[im_ind] = True
+        gt = self._gt_order[self._gt_offsets[im_ind]:self._gt_offsets[im_ind + 1]]
+        gt_class = self._gt_class[gt]
+        self._npos += np.bincount(gt_class[(gt_class >= 0) & ~self._gt_difficult[gt]], minlength=len(self._npos))
+        det_class = det[:, 0].astype(np.int64)
+        for cls_ind in np.unique(det_class).tolist():
+            cls_gt = gt[gt_class == cls_ind]
+            cls_det = det[det_class == cls_ind]
+            # bbox is 1-based
+            match = PascalVOC.voc_match(np.full((len(cls_gt),), im_ind), self._gt_bbox[cls_gt],
+                                        self._gt_difficult[cls_gt], np.full((len(cls_det),), im_ind),
+                                        cls_det[:, 2:6] + 1)
+            match[match >= 0] = cls_gt[match[match >= 0]]
+            self._image_ids[cls_ind].append(im_ind)
+            # copy, a view would keep cls_det alive
+            self._confidence[cls_ind].append(cls_det[:, 1].copy())
+            self._match[cls_ind].append(match)
+
+    def evaluate(self):
+        """rec, prec, ap of every class of cls_inds, equal to _do_python_eval once all images are seen"""
+        return [self._eval_class(cls_ind) for cls_ind in self.cls_inds]
+
+    def mean_ap(self):
+        """
+        mean ap of the classes with gt boxes in the images seen so far
+        detections added since the last call are merged into sorted state instead of sorting all again,
+        equal confidences keep arrival order, so ties may rank differently than in evaluate
+        """
+        aps = []
+        for cls_ind in self.cls_inds:
+            self._merge_sorted(cls_ind)
+            if self._npos[cls_ind] > 0:
+                aps.append(PascalVOC.voc_pr_sorted(self._sorted_match[cls_ind], self._npos[cls_ind],
+                                                   self._use_07_metric)[2])
+        return np.mean(aps) if aps else 0.
+
+    def log_results(self):
+        self._imdb._log_results(self.cls_inds, self.evaluate())
+
+    def _eval_class(self, cls_ind):
+        # chunks in image order as batch evaluation concatenates detections, so that ties sort the same
+        order = np.argsort(np.array(self._image_ids[cls_ind], dtype=np.int64), kind='mergesort')
+        confidence = np.concatenate([self._confidence[cls_ind][i] for i in order] + [np.zeros((0,), dtype=np.float64)])
+        match = np.concatenate([self._match[cls_ind][i] for i in order] + [np.zeros((0,), dtype=np.int64)])
+        return PascalVOC.voc_pr(match, confidence, self._npos[cls_ind], self._use_07_metric)
+
+    def _merge_sorted(self, cls_ind):
+        """merge the chunks of cls_ind added since the last merge into its sorted confidence and match"""
+        num_merged = self._num_merged[cls_ind]
+        if num_merged == len(self._match[cls_ind]):
+            return
+        confidence = np.concatenate(self._confidence[cls_ind][num_merged:])
+        match = np.concatenate(self._match[cls_ind][num_merged:])
+        order = np.argsort(-confidence, kind='mergesort')
+        confidence, match = confidence[order], match[order]
+        # new detections go after sorted ones of equal confidence
+        pos = np.searchsorted(-self._sorted_confidence[cls_ind], -confidence, side='right')
+        self._sorted_confidence[cls_ind] = np.insert(self._sorted_confidence[cls_ind], pos, confidence)
+        self._sorted_match[cls_ind] = np.insert(self._sorted_match[cls_ind], pos, match)
+        self._num_merged[cls_ind] = len(self._match[cls_ind])
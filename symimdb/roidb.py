@@ -0,0 +1,252 @@
+"""
+Columnar roidb, a drop-in replacement of the list of roi_rec dicts.
+
+Per-image fields are arrays of length num_images, per-box and per-object fields are flat arrays
+sliced by offsets and strings are fixed width utf-8 byte arrays. Every column is saved as a .npy file
+in a cache folder and memory-mapped when loaded, so loading is instant and forked workers share pages.
+roidb[i] returns a RoiRec, a read-only view that behaves like the roi_rec dict.
+Boxes are always stored in original image coordinates, "flipped" images and their boxes are flipped
+by symdata.image.load_image, so flipped copies of a roidb are only an index view (see append_flipped).
+"""
+
+import os
+import shutil
+import numpy as np
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+# per-image columns, 'index' is int64 for integer ids and utf-8 bytes otherwise
+IMAGE_FIELDS = ('index', 'image', 'height', 'width', 'flipped')
+# per-box columns sliced by box_offsets
+BOX_FIELDS = ('boxes', 'gt_classes')
+# per-object columns sliced by obj_offsets, roi_rec['objs'] of pascal voc
+OBJ_FIELDS = ('obj_name', 'obj_difficult', 'obj_bbox')
+
+
+def _encode(strings):
+    """fixed width utf-8 byte array of strings"""
+    return np.array([str(s).encode('utf-8') for s in strings], dtype=np.bytes_)
+
+
+def _take_ragged(offsets, inds):
+    """flat positions and new offsets of the ragged rows inds"""
+    lengths = offsets[inds + 1] - offsets[inds]
+    new_offsets = np.zeros((len(inds) + 1,), dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    flat = np.repeat(offsets[inds] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return flat, new_offsets
+
+
+def save_columns(path, columns, extra=None):
+    """
+    save dict of arrays columns as path/<key>.npy, the folder appears or is replaced only when complete
+    :param extra: dict of arrays saved as path/extra/<key>.npy, not loaded by load_columns
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(os.path.join(tmp_path, 'extra'))
+    for key, value in columns.items():
+        np.save(os.path.join(tmp_path, key + '.npy'), value)
+    for key, value in (extra or {}).items():
+        np.save(os.path.join(tmp_path, 'extra', key + '.npy'), value)
+    if os.path.exists(path):
+        # memory-mapped columns of the old folder stay valid after it is removed
+        old_path = path + '.old'
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(tmp_path, path)
+
+
+def load_columns(path, mmap_mode='r'):
+    """dict of the arrays saved by save_columns, memory-mapped by default"""
+    columns = dict()
+    for filename in os.listdir(path):
+        key, ext = os.path.splitext(filename)
+        if ext == '.npy':
+            columns[key] = np.load(os.path.join(path, filename), mmap_mode=mmap_mode)
+    return columns
+
+
+class RoiRec(Mapping):
+    """view of one image of a Roidb with the keys of roi_rec, flip inverts its flipped value"""
+    def __init__(self, roidb, i, flip=False):
+        self._roidb = roidb
+        self._i = i
+        self._flip = flip
+
+    def __getitem__(self, key):
+        columns = self._roidb.columns
+        i = self._i
+        if key in BOX_FIELDS:
+            offsets = columns['box_offsets']
+            return columns[key][offsets[i]:offsets[i + 1]]
+        if key == 'objs' and 'obj_offsets' in columns:
+            begin, end = columns['obj_offsets'][i:i + 2]
+            return [{'name': columns['obj_name'][k].decode('utf-8'),
+                     'difficult': int(columns['obj_difficult'][k]),
+                     'bbox': columns['obj_bbox'][k].tolist()} for k in range(begin, end)]
+        if key == 'flipped':
+            return bool(columns[key][i]) != self._flip
+        if key in IMAGE_FIELDS:
+            value = columns[key][i]
+            return value.decode('utf-8') if isinstance(value, np.bytes_) else value.item()
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key in IMAGE_FIELDS + BOX_FIELDS:
+            yield key
+        if 'obj_offsets' in self._roidb.columns:
+            yield 'objs'
+
+    def __len__(self):
+        return len(IMAGE_FIELDS + BOX_FIELDS) + ('obj_offsets' in self._roidb.columns)
+
+    def copy(self):
+        return dict(self)
+
+
+class Roidb(object):
+    def __init__(self, columns, append_flipped=False):
+        """
+        :param columns: dict of IMAGE_FIELDS, BOX_FIELDS with box_offsets and optionally OBJ_FIELDS with obj_offsets
+        :param append_flipped: index i >= n of the n stored images is image i - n flipped
+        """
+        self._columns = columns
+        self._append_flipped = append_flipped
+        self._num_stored = len(columns['height'])
+
+    @classmethod
+    def from_records(cls, roi_recs):
+        """pack a list of roi_rec dicts"""
+        columns = dict()
+        for key in IMAGE_FIELDS:
+            columns[key] = np.array([roi_rec[key] for roi_rec in roi_recs])
+        if columns['index'].dtype.kind in 'iu':
+            columns['index'] = columns['index'].astype(np.int64)
+        else:
+            columns['index'] = _encode(columns['index'])
+        columns['image'] = _encode(columns['image'])
+        columns['height'] = columns['height'].astype(np.int32)
+        columns['width'] = columns['width'].astype(np.int32)
+        columns['flipped'] = columns['flipped'].astype(bool)
+
+        columns['box_offsets'] = np.zeros((len(roi_recs) + 1,), dtype=np.int64)
+        np.cumsum([len(roi_rec['boxes']) for roi_rec in roi_recs], out=columns['box_offsets'][1:])
+        columns['boxes'] = np.concatenate([roi_rec['boxes'] for roi_rec in roi_recs] +
+                                          [np.zeros((0, 4), dtype=np.uint16)])
+        columns['gt_classes'] = np.concatenate([roi_rec['gt_classes'] for roi_rec in roi_recs] +
+                                               [np.zeros((0,), dtype=np.int32)])
+
+        if roi_recs and 'objs' in roi_recs[0]:
+            objs = [obj for roi_rec in roi_recs for obj in roi_rec['objs']]
+            columns['obj_offsets'] = np.zeros((len(roi_recs) + 1,), dtype=np.int64)
+            np.cumsum([len(roi_rec['objs']) for roi_rec in roi_recs], out=columns['obj_offsets'][1:])
+            columns['obj_name'] = _encode([obj['name'] for obj in objs])
+            columns['obj_difficult'] = np.array([obj['difficult'] for obj in objs], dtype=np.int32)
+            columns['obj_bbox'] = np.array([obj['bbox'] for obj in objs], dtype=np.int32).reshape((-1, 4))
+        return cls(columns)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """load columns saved by save, memory-mapped by default"""
+        return cls(load_columns(path, mmap_mode))
+
+    def save(self, path, extra=None):
+        """
+        save every column as path/<column>.npy, the folder appears or is replaced only when complete
+        :param extra: dict of arrays saved as path/extra/<key>.npy, not loaded as columns
+        """
+        save_columns(path, self._columns, extra)
+
+    @staticmethod
+    def load_extra(path):
+        """dict of the extra arrays saved with the columns in path"""
+        extra_path = os.path.join(path, 'extra')
+        if not os.path.isdir(extra_path):
+            return dict()
+        return dict((os.path.splitext(filename)[0], np.load(os.path.join(extra_path, filename)))
+                    for filename in os.listdir(extra_path) if filename.endswith('.npy'))
+
+    @classmethod
+    def concat(cls, roidbs):
+        """a new Roidb of all images of roidbs in order"""
+        roidbs = [roidb if isinstance(roidb, Roidb) else Roidb.from_records(roidb) for roidb in roidbs]
+        # flipped views become stored images with "flipped" set, concat before append_flipped to avoid the copy
+        roidbs = [roidb.take(np.arange(len(roidb))) if roidb.is_flipped_view else roidb for roidb in roidbs]
+        keys = set(roidbs[0].columns)
+        assert all(set(roidb.columns) == keys for roidb in roidbs), 'roidbs have different columns'
+        columns = dict()
+        for key in keys:
+            if key.endswith('_offsets'):
+                shifts = np.cumsum([0] + [roidb.columns[key][-1] for roidb in roidbs[:-1]])
+                columns[key] = np.concatenate([roidbs[0].columns[key][:1]] +
+                                              [roidb.columns[key][1:] + shift for roidb, shift in zip(roidbs, shifts)])
+            else:
+                columns[key] = np.concatenate([roidb.columns[key] for roidb in roidbs])
+        return cls(columns)
+
+    @property
+    def columns(self):
+        """columns of the stored images, without the images of append_flipped"""
+        return self._columns
+
+    @property
+    def is_flipped_view(self):
+        return self._append_flipped
+
+    @property
+    def num_boxes(self):
+        """number of boxes of every image"""
+        num_boxes = np.diff(self._columns['box_offsets'])
+        return np.tile(num_boxes, 2) if self._append_flipped else num_boxes
+
+    def __len__(self):
+        return 2 * self._num_stored if self._append_flipped else self._num_stored
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(np.arange(len(self))[i])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('roidb index out of range')
+        if i >= self._num_stored:
+            return RoiRec(self, i - self._num_stored, flip=True)
+        return RoiRec(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, inds):
+        """a new Roidb of images inds"""
+        inds = np.asarray(inds, dtype=np.int64)
+        flip = inds >= self._num_stored
+        inds = inds - flip * self._num_stored
+        columns = dict()
+        for key in IMAGE_FIELDS:
+            columns[key] = self._columns[key][inds]
+        columns['flipped'] = columns['flipped'] != flip
+        for offsets_key, fields in (('box_offsets', BOX_FIELDS), ('obj_offsets', OBJ_FIELDS)):
+            if offsets_key not in self._columns:
+                continue
+            flat, columns[offsets_key] = _take_ragged(self._columns[offsets_key], inds)
+            for key in fields:
+                columns[key] = self._columns[key][flat]
+        return Roidb(columns)
+
+    def append_flipped(self):
+        """a view of these images followed by their horizontally flipped copies, no data is copied"""
+        assert not self._append_flipped, 'flipped images are already appended'
+        boxes = self._columns['boxes']
+        assert (boxes[:, 2] >= boxes[:, 0]).all()
+        return Roidb(self._columns, append_flipped=True)
@@ -69,7 +69,7 @@ def get_resnet_train(anchor_scales, anchor_ratios, rpn_feature_stride,
                      rpn_pre_topk, rpn_post_topk, rpn_nms_thresh, rpn_min_size, rpn_batch_rois,
                      num_classes, rcnn_feature_stride, rcnn_pooled_size, rcnn_batch_size,
                      rcnn_batch_rois, rcnn_fg_fraction, rcnn_fg_overlap, rcnn_bbox_stds,
-                     units, filter_list):
+                     units, filter_list, rcnn_device_sampling=False):
     num_anchors = len(anchor_scales) * len(anchor_ratios)
 
     data = mx.symbol.Variable(name="data")
@@ -113,10 +113,16 @@ def get_resnet_train(anchor_scales, anchor_ratios, rpn_feature_stride,
         threshold=rpn_nms_thresh, rpn_min_size=rpn_min_size)
 
     # rcnn roi proposal target
-    group = mx.symbol.Custom(rois=rois, gt_boxes=gt_boxes, op_type='proposal_target',
-                             num_classes=num_classes, batch_images=rcnn_batch_size,
-                             batch_rois=rcnn_batch_rois, fg_fraction=rcnn_fg_fraction,
-                             fg_overlap=rcnn_fg_overlap, box_stds=rcnn_bbox_stds)
+    if rcnn_device_sampling:
+        group = proposal_target.proposal_target_sym(rois, gt_boxes, num_classes=num_classes,
+                                                    batch_images=rcnn_batch_size, batch_rois=rcnn_batch_rois,
+                                                    fg_fraction=rcnn_fg_fraction, fg_overlap=rcnn_fg_overlap,
+                                                    box_stds=rcnn_bbox_stds)
+    else:
+        group = mx.symbol.Custom(rois=rois, gt_boxes=gt_boxes, op_type='proposal_target',
+                                 num_classes=num_classes, batch_images=rcnn_batch_size,
+                                 batch_rois=rcnn_batch_rois, fg_fraction=rcnn_fg_fraction,
+                                 fg_overlap=rcnn_fg_overlap, box_stds=rcnn_bbox_stds)
     rois = group[0]
     label = group[1]
     bbox_target = group[2]
@@ -1,6 +1,9 @@
 import argparse
 import ast
+import collections
 import pprint
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import mxnet as mx
 from mxnet.module import Module
@@ -8,7 +11,9 @@ import numpy as np
 from tqdm import tqdm
 
 from symdata.bbox import im_detect
+from symdata.image import DECODERS, get_decoder
 from symdata.loader import TestLoader
+from symimdb.detections import Detections
 from symnet.logger import logger
 from symnet.model import load_param, check_shape
 
@@ -21,8 +26,9 @@ def test_net(sym, imdb, args):
     ctx = mx.gpu(args.gpu)
 
     # load testing data
-    test_data = TestLoader(imdb.roidb, batch_size=1, short=args.img_short_side, max_size=args.img_long_side,
-                           mean=args.img_pixel_means, std=args.img_pixel_stds)
+    test_data = TestLoader(imdb.roidb, batch_size=args.batch_size, short=args.img_short_side,
+                           max_size=args.img_long_side, mean=args.img_pixel_means, std=args.img_pixel_stds,
+                           num_workers=args.num_workers, prefetch=args.prefetch, decoder=get_decoder(args.img_decoder))
 
     # load params
     arg_params, aux_params = load_param(args.params, ctx=ctx)
@@ -30,7 +36,8 @@ def test_net(sym, imdb, args):
     # produce shape max possible
     data_names = ['data', 'im_info']
     label_names = None
-    data_shapes = [('data', (1, 3, args.img_long_side, args.img_long_side)), ('im_info', (1, 3))]
+    data_shapes = [('data', (args.batch_size, 3, args.img_long_side, args.img_long_side)),
+                   ('im_info', (args.batch_size, 3))]
     label_shapes = None
 
     # check shapes
@@ -41,34 +48,77 @@ def test_net(sym, imdb, args):
     mod.bind(data_shapes, label_shapes, for_training=False)
     mod.init_params(arg_params=arg_params, aux_params=aux_params)
 
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in range(imdb.num_images)]
-                 for _ in range(imdb.num_classes)]
+    # detections of every image are collected into:
+    #    dets[image] = N x 6 array of detections in
+    #    (cls, score, x1, y1, x2, y2)
+    # and packed into a columnar Detections for evaluation,
+    # streaming evaluation only keeps the score and matched gt of every detection
+    dets = [np.zeros((0, 6), dtype=np.float64) for _ in range(imdb.num_images)] if not args.stream_eval else None
+    accumulator = imdb.detection_accumulator() if args.stream_eval or args.eval_interval > 0 else None
+
+    num_pruned = np.zeros((imdb.num_images,), dtype=np.int64)
+
+    def _collect(i, result):
+        det, num_pruned[i] = result
+        if not args.stream_eval:
+            dets[i] = det
+        if accumulator is not None:
+            accumulator.update(i, det)
+            if args.eval_interval > 0 and accumulator.num_images % args.eval_interval == 0:
+                logger.info('running mAP of {} images = {:.4f}'.format(accumulator.num_images, accumulator.mean_ap()))
+
+    det_kwargs = dict(bbox_stds=args.rcnn_bbox_stds, nms_thresh=args.rcnn_nms_thresh,
+                      conf_thresh=args.rcnn_conf_thresh, use_soft_nms=args.use_soft_nms,
+                      soft_nms_thresh=args.soft_nms_thresh, max_per_image=args.max_per_image,
+                      soft_nms_method=args.soft_nms_method, return_pruned=True)
+
+    # postprocessing threads let im_detect of this batch overlap with forward of the next one
+    executor = ThreadPoolExecutor(args.post_threads) if args.post_threads > 0 else None
+    pending = collections.deque()
 
     # start detection
+    tic = time.time()
     with tqdm(total=imdb.num_images) as pbar:
-        for i, data_batch in enumerate(test_data):
+        for data_batch in test_data:
             # forward
-            im_info = data_batch.data[1][0]
             mod.forward(data_batch)
-            rois, scores, bbox_deltas = mod.get_outputs()
-            rois = rois[:, 1:]
-            scores = scores[0]
-            bbox_deltas = bbox_deltas[0]
-
-            det = im_detect(rois, scores, bbox_deltas, im_info,
-                            bbox_stds=args.rcnn_bbox_stds, nms_thresh=args.rcnn_nms_thresh,
-                            conf_thresh=args.rcnn_conf_thresh, use_soft_nms=args.use_soft_nms,
-                            soft_nms_thresh=args.soft_nms_thresh, max_per_image=args.max_per_image)
-            for j in range(1, imdb.num_classes):
-                indexes = np.where(det[:, 0] == j)[0]
-                all_boxes[j][i] = np.concatenate((det[:, -4:], det[:, [1]]), axis=-1)[indexes, :]
-            pbar.update(data_batch.data[0].shape[0])
+            rois, scores, bbox_deltas = [x.asnumpy() for x in mod.get_outputs()]
+            im_info = data_batch.data[1].asnumpy()
+
+            # split outputs by the batch index of rois, padded images at the tail are not in data_batch.index
+            for batch_ind, i in enumerate(data_batch.index):
+                b_rois = rois[rois[:, 0] == batch_ind, 1:]
+                det_args = (b_rois, scores[batch_ind], bbox_deltas[batch_ind], im_info[batch_ind])
+                if executor is None:
+                    _collect(i, im_detect(*det_args, **det_kwargs))
+                else:
+                    pending.append((i, executor.submit(im_detect, *det_args, **det_kwargs)))
+
+            # bound the number of outputs held by unfinished postprocessing
+            while len(pending) > 2 * args.post_threads * args.batch_size:
+                i, future = pending.popleft()
+                _collect(i, future.result())
+            pbar.update(len(data_batch.index))
+        while pending:
+            i, future = pending.popleft()
+            _collect(i, future.result())
+    if executor is not None:
+        executor.shutdown()
+    logger.info('detected {} images at {:.1f} images/s with batch size {}'.format(
+        imdb.num_images, imdb.num_images / (time.time() - tic), args.batch_size))
+    logger.info('max_per_image {} pruned {} detections in {} images, at most {} per image'.format(
+        args.max_per_image, num_pruned.sum(), np.count_nonzero(num_pruned), num_pruned.max()))
+    calls, seconds = test_data.decoder.reset_stats()
+    logger.info('{} decoded {} images at {:.2f} ms per image'.format(
+        test_data.decoder.name, calls, 1e3 * seconds / max(calls, 1)))
+    test_data.close()
 
     # evaluate model
-    imdb.evaluate_detections(all_boxes)
+    if args.stream_eval:
+        accumulator.log_results()
+    else:
+        imdb.evaluate_detections(Detections.from_images(dets), write_results=not args.no_results_file,
+                                 eval_workers=args.eval_workers)
 
 
 def parse_args():
@@ -79,9 +129,25 @@ def parse_args():
     parser.add_argument('--dataset', type=str, default='voc', help='training dataset')
     parser.add_argument('--imageset', type=str, default='', help='imageset splits')
     parser.add_argument('--gpu', type=int, default=0, help='gpu device eg. 0')
+    parser.add_argument('--batch-size', type=int, default=1, help='images per forward pass')
+    parser.add_argument('--post-threads', type=int, default=0, help='postprocessing threads, 0 runs inline')
+    parser.add_argument('--num-workers', type=int, default=0, help='data loading processes, 0 loads in main thread')
+    parser.add_argument('--prefetch', type=int, default=4, help='number of batches prefetched by workers')
+    parser.add_argument('--no-results-file', action='store_true',
+                        help='evaluate coco detections in memory without writing the results json')
+    parser.add_argument('--eval-workers', type=int, default=1,
+                        help='processes computing per-class ap in parallel, 1 evaluates inline')
+    parser.add_argument('--stream-eval', action='store_true',
+                        help='evaluate voc detections image by image without keeping them or writing results files')
+    parser.add_argument('--eval-interval', type=int, default=0,
+                        help='images between running mAP reports of voc, 0 disables')
+    parser.add_argument('--eval-cached', action='store_true',
+                        help='evaluate the detections cached by the last run without running the network')
     # faster rcnn params
     parser.add_argument('--img-short-side', type=int, default=600)
     parser.add_argument('--img-long-side', type=int, default=1000)
+    parser.add_argument('--img-decoder', type=str, default='opencv', choices=sorted(DECODERS),
+                        help='opencv-reduced decodes jpegs at 1/2, 1/4 or 1/8 size when the image is shrunk that much')
     parser.add_argument('--img-pixel-means', type=str, default='(0.0, 0.0, 0.0)')
     parser.add_argument('--img-pixel-stds', type=str, default='(1.0, 1.0, 1.0)')
     parser.add_argument('--rpn-feat-stride', type=int, default=16)
@@ -94,23 +160,27 @@ def parse_args():
     parser.add_argument('--rcnn-num-classes', type=int, default=21)
     parser.add_argument('--rcnn-feat-stride', type=int, default=16)
     parser.add_argument('--rcnn-pooled-size', type=str, default='(14, 14)')
-    parser.add_argument('--rcnn-batch-size', type=int, default=1)
     parser.add_argument('--rcnn-bbox-stds', type=str, default='(0.1, 0.1, 0.2, 0.2)')
     parser.add_argument('--rcnn-nms-thresh', type=float, default=0.3)
     parser.add_argument('--rcnn-conf-thresh', type=float, default=1e-3)
     # Add soft nms by liusm 20180929
-    parser.add_argument('--use-soft-nms', type=bool, default=True)
-    parser.add_argument('--soft-nms-thresh', type=float, default=0.6)
+    parser.add_argument('--use-soft-nms', action='store_true', help='decay scores instead of hard nms')
+    parser.add_argument('--soft-nms-method', type=str, default='gaussian', choices=['linear', 'gaussian'])
+    parser.add_argument('--soft-nms-thresh', type=float, default=0.6, help='gaussian sigma or linear overlap')
     parser.add_argument('--max-per-image', type=int, default=100)
     # if use deformable conv add by liusm 20181009
     parser.add_argument('--use-deformable-conv', action='store_true')
     args = parser.parse_args()
+    if (args.stream_eval or args.eval_interval > 0) and args.dataset != 'voc':
+        parser.error('--stream-eval and --eval-interval only support --dataset voc')
     args.img_pixel_means = ast.literal_eval(args.img_pixel_means)
     args.img_pixel_stds = ast.literal_eval(args.img_pixel_stds)
     args.rpn_anchor_scales = ast.literal_eval(args.rpn_anchor_scales)
     args.rpn_anchor_ratios = ast.literal_eval(args.rpn_anchor_ratios)
     args.rcnn_pooled_size = ast.literal_eval(args.rcnn_pooled_size)
     args.rcnn_bbox_stds = ast.literal_eval(args.rcnn_bbox_stds)
+    # test symbol splits rcnn outputs per image
+    args.rcnn_batch_size = args.batch_size
     return args
 
 
@@ -208,6 +278,9 @@ def get_network(network, args):
 def main():
     args = parse_args()
     imdb = get_dataset(args.dataset, args)
+    if args.eval_cached:
+        imdb.evaluate_cached_detections(write_results=not args.no_results_file, eval_workers=args.eval_workers)
+        return
     sym = get_network(args.network, args)
     test_net(sym, imdb, args)
 
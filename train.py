@@ -2,19 +2,49 @@ import argparse
 import ast
 import pprint
 import os
+import time
 
 import mxnet as mx
 from mxnet.module import Module
+import numpy as np
 
+from symdata.image import DECODERS, get_decoder
 from symdata.loader import AnchorGenerator, AnchorSampler, AnchorLoader
+from symimdb.roidb import Roidb
 from symnet.logger import logger
 from symnet.model import load_param, infer_data_shape, check_shape, initialize_frcnn, get_fixed_params, initialize_deform_conv
+from symnet.proposal_target import ProposalTargetOperator
 from symnet.metric import RPNAccMetric, RPNLogLossMetric, RPNL1LossMetric, RCNNAccMetric, RCNNLogLossMetric, RCNNL1LossMetric
 
 os.environ['MXNET_CUDNN_AUTOTUNE_DEFAULT'] = '0'
 os.environ['MXNET_ENABLE_GPU_P2P'] = '0'
 
 
+class StepTimer(object):
+    """log mean step time and the share of it spent sampling proposal targets on the host"""
+    def __init__(self, frequent):
+        self._op = ProposalTargetOperator
+        self._frequent = frequent
+        self._tic = None
+
+    def _reset(self):
+        self._tic = time.time()
+        self._host_seconds = self._op.host_seconds
+        self._host_calls = self._op.host_calls
+
+    def __call__(self, param):
+        if self._tic is None or param.nbatch == 0:
+            self._reset()
+            return
+        if param.nbatch % self._frequent == 0:
+            step = (time.time() - self._tic) / self._frequent
+            host = (self._op.host_seconds - self._host_seconds) / self._frequent
+            calls = self._op.host_calls - self._host_calls
+            logger.info('Epoch[%d] Batch [%d]\tstep %.1f ms\tproposal_target on host %.1f ms (%d calls)' % (
+                param.epoch, param.nbatch, step * 1e3, host * 1e3, calls))
+            self._reset()
+
+
 def train_net(sym, roidb, args):
     # print config
     logger.info('called with args\n{}'.format(pprint.pformat(vars(args))))
@@ -31,7 +61,10 @@ def train_net(sym, roidb, args):
                         fg_fraction=args.rpn_fg_fraction, fg_overlap=args.rpn_fg_overlap,
                         bg_overlap=args.rpn_bg_overlap)
     train_data = AnchorLoader(roidb, batch_size, args.img_short_side, args.img_long_side,
-                              args.img_pixel_means, args.img_pixel_stds, feat_sym, ag, asp, shuffle=True)
+                              args.img_pixel_means, args.img_pixel_stds, feat_sym, ag, asp, shuffle=True,
+                              num_workers=args.num_workers, prefetch=args.prefetch,
+                              aspect_grouping=args.aspect_grouping, random_flip=args.random_flip,
+                              decoder=get_decoder(args.img_decoder))
 
     # produce shape max possible
     _, out_shape, _ = feat_sym.infer_shape(data=(1, 3, args.img_long_side, args.img_long_side))
@@ -79,7 +112,8 @@ def train_net(sym, roidb, args):
         eval_metrics.add(child_metric)
 
     # callback
-    batch_end_callback = mx.callback.Speedometer(batch_size, frequent=args.log_interval, auto_reset=False)
+    batch_end_callback = [mx.callback.Speedometer(batch_size, frequent=args.log_interval, auto_reset=False),
+                          StepTimer(args.log_interval)]
     epoch_end_callback = mx.callback.do_checkpoint(args.save_prefix)
 
     # learning schedule
@@ -107,6 +141,7 @@ def train_net(sym, roidb, args):
             batch_end_callback=batch_end_callback, kvstore='device',
             optimizer='sgd', optimizer_params=optimizer_params,
             arg_params=arg_params, aux_params=aux_params, begin_epoch=args.start_epoch, num_epoch=args.epochs)
+    train_data.close()
 
 
 def parse_args():
@@ -124,9 +159,16 @@ def parse_args():
     parser.add_argument('--start-epoch', type=int, default=0, help='start epoch for resuming')
     parser.add_argument('--log-interval', type=int, default=100, help='logging mini batch interval')
     parser.add_argument('--save-prefix', type=str, default='', help='saving params prefix')
+    parser.add_argument('--num-workers', type=int, default=0, help='data loading processes, 0 loads in main thread')
+    parser.add_argument('--prefetch', type=int, default=4, help='number of batches prefetched by workers')
+    parser.add_argument('--aspect-grouping', action='store_true', help='batch images of similar aspect ratio')
+    parser.add_argument('--random-flip', action='store_true',
+                        help='flip every image with probability 0.5 instead of appending flipped images to each epoch')
     # faster rcnn params
     parser.add_argument('--img-short-side', type=int, default=600)
     parser.add_argument('--img-long-side', type=int, default=1000)
+    parser.add_argument('--img-decoder', type=str, default='opencv', choices=sorted(DECODERS),
+                        help='opencv-reduced decodes jpegs at 1/2, 1/4 or 1/8 size when the image is shrunk that much')
     parser.add_argument('--img-pixel-means', type=str, default='(0.0, 0.0, 0.0)')
     parser.add_argument('--img-pixel-stds', type=str, default='(1.0, 1.0, 1.0)')
     parser.add_argument('--net-fixed-params', type=str, default='["conv0", "stage1", "gamma", "beta"]')
@@ -150,6 +192,8 @@ def parse_args():
     parser.add_argument('--rcnn-fg-fraction', type=float, default=0.25)
     parser.add_argument('--rcnn-fg-overlap', type=float, default=0.5)
     parser.add_argument('--rcnn-bbox-stds', type=str, default='(0.1, 0.1, 0.2, 0.2)')
+    parser.add_argument('--rcnn-device-sampling', action='store_true',
+                        help='sample rcnn rois with symbol operators on the device instead of the host')
     # if use deformable conv add by liusm 20180930
     parser.add_argument('--use-deformable-conv', action='store_true')
     args = parser.parse_args()
@@ -163,6 +207,17 @@ def parse_args():
     return args
 
 
+def get_train_roidb(roidbs, name):
+    """roidb of all imagesets, memory-mapped from the cache folder so that loader workers share its pages"""
+    roidb = roidbs[0] if len(roidbs) == 1 else Roidb.concat(roidbs)
+    if not all(isinstance(column, np.memmap) for column in roidb.columns.values()):
+        cache_path = os.path.join('data', 'cache', '{}_train_roidb'.format(name))
+        logger.info('saving cache {}'.format(cache_path))
+        roidb.save(cache_path)
+        roidb = Roidb.load(cache_path)
+    return roidb
+
+
 def get_voc(args):
     from symimdb.pascal_voc import PascalVOC
     if not args.imageset:
@@ -170,13 +225,14 @@ def get_voc(args):
     args.rcnn_num_classes = len(PascalVOC.classes)
 
     isets = args.imageset.split('+')
-    roidb = []
+    roidbs = []
     for iset in isets:
         imdb = PascalVOC(iset, 'data', 'data/VOCdevkit')
         imdb.filter_roidb()
-        imdb.append_flipped_images()
-        roidb.extend(imdb.roidb)
-    return roidb
+        roidbs.append(imdb.roidb)
+    roidb = get_train_roidb(roidbs, 'voc_' + args.imageset)
+    # flipped images are an index view appended once to all imagesets
+    return roidb if args.random_flip else roidb.append_flipped()
 
 
 def get_coco(args):
@@ -186,13 +242,14 @@ def get_coco(args):
     args.rcnn_num_classes = len(coco.classes)
 
     isets = args.imageset.split('+')
-    roidb = []
+    roidbs = []
     for iset in isets:
         imdb = coco(iset, 'data', 'data/coco')
         imdb.filter_roidb()
-        imdb.append_flipped_images()
-        roidb.extend(imdb.roidb)
-    return roidb
+        roidbs.append(imdb.roidb)
+    roidb = get_train_roidb(roidbs, 'coco_' + args.imageset)
+    # flipped images are an index view appended once to all imagesets
+    return roidb if args.random_flip else roidb.append_flipped()
 
 
 def get_vgg16_train(args):
@@ -214,7 +271,8 @@ def get_vgg16_train(args):
                          num_classes=args.rcnn_num_classes, rcnn_feature_stride=args.rcnn_feat_stride,
                          rcnn_pooled_size=args.rcnn_pooled_size, rcnn_batch_size=args.rcnn_batch_size,
                          rcnn_batch_rois=args.rcnn_batch_rois, rcnn_fg_fraction=args.rcnn_fg_fraction,
-                         rcnn_fg_overlap=args.rcnn_fg_overlap, rcnn_bbox_stds=args.rcnn_bbox_stds)
+                         rcnn_fg_overlap=args.rcnn_fg_overlap, rcnn_bbox_stds=args.rcnn_bbox_stds,
+                         rcnn_device_sampling=args.rcnn_device_sampling)
 
 
 def get_resnet50_train(args):
@@ -237,7 +295,8 @@ def get_resnet50_train(args):
                             rcnn_pooled_size=args.rcnn_pooled_size, rcnn_batch_size=args.rcnn_batch_size,
                             rcnn_batch_rois=args.rcnn_batch_rois, rcnn_fg_fraction=args.rcnn_fg_fraction,
                             rcnn_fg_overlap=args.rcnn_fg_overlap, rcnn_bbox_stds=args.rcnn_bbox_stds,
-                            units=(3, 4, 6, 3), filter_list=(256, 512, 1024, 2048))
+                            units=(3, 4, 6, 3), filter_list=(256, 512, 1024, 2048),
+                            rcnn_device_sampling=args.rcnn_device_sampling)
 
 
 def get_resnet101_train(args):
@@ -267,7 +326,8 @@ def get_resnet101_train(args):
                             rcnn_pooled_size=args.rcnn_pooled_size, rcnn_batch_size=args.rcnn_batch_size,
                             rcnn_batch_rois=args.rcnn_batch_rois, rcnn_fg_fraction=args.rcnn_fg_fraction,
                             rcnn_fg_overlap=args.rcnn_fg_overlap, rcnn_bbox_stds=args.rcnn_bbox_stds,
-                            units=(3, 4, 23, 3), filter_list=(256, 512, 1024, 2048))
+                            units=(3, 4, 23, 3), filter_list=(256, 512, 1024, 2048),
+                            rcnn_device_sampling=args.rcnn_device_sampling)
 
 
 def get_dataset(dataset, args):